@@ -0,0 +1,104 @@
+# ─── SCRIPT PARAMETERS ──────────────────────────────────────────────────────────
+
+#@ File[] (label="Select first CZI files", description="the first czi file of each dataset", style="files") input_paths
+#@ File (label="Select the BigStitcher script", description="zeiss-lightsheet-bigstitcher.py, run for each dataset in this Fiji", style="extensions:py") pipeline_script
+#@ String (label="What reader to use ?", choices={"LightSheet 7 (Zen tiling)","LightSheet Z.1 / 7 (Tile scan macro)"}, style="listBox") reader
+#@ Boolean (label="Automatically select best illumination side", description="discard the other illumination", value=false) autoselect_illuminations
+#@ Integer (label="Register while resaving (timepoints in flight)", description="calculate the shifts of each timepoint as soon as it is resaved, while up to this many timepoints are resaved ahead. 0 = resave all timepoints first", min=0, max=16, value=2) timepoints_in_flight
+#@ Boolean (label="Fuse image", description="save dataset as fused xml/tiff images or as h5/xml if size is too large", value=true) fuse
+#@ String (label="Fused image export", choices={"16-bit","16-bit LZW compressed","8-bit rescaled"}, description="8-bit maps the 0.1 to 99.9 percentiles of each channel to 0-255", style="listBox") export_type
+#@ Boolean (label="Convert fused image to Imaris5", description="convert to fused image to *.ims", value=true) convert_to_ims
+#@ Boolean (label="Delete intermediate files", description="keep only final fused image", value=true) delete_temp_files
+#@ String (label="Send info email to: ", description="empty = skip") email_address
+#@ Boolean (label="Dry run", description="only print the execution plan with cost estimates, nothing is processed", value=false) dry_run
+#@ ScriptService scripts
+
+# ─── IMPORTS ────────────────────────────────────────────────────────────────────
+
+# python imports
+import os
+import time
+
+# Imagej imports
+from ij import IJ
+
+# java imports
+from java.util import HashMap
+
+# requirements:
+# zeiss-lightsheet-bigstitcher.py and its requirements
+
+# ─── FUNCTIONS ──────────────────────────────────────────────────────────────────
+
+
+def get_pipeline_inputs(input_path, estimator_cache):
+    """Get the script parameters of the BigStitcher script for one dataset
+
+    Parameters
+    ----------
+    input_path : java.io.File
+        The first CZI file of the dataset
+    estimator_cache : str
+        Path of the json file shared by all datasets of the batch
+
+    Returns
+    -------
+    java.util.HashMap
+        The value of every script parameter
+    """
+    inputs = HashMap()
+    inputs.put("input_path", input_path)
+    inputs.put("reader", reader)
+    inputs.put("autoselect_illuminations", autoselect_illuminations)
+    inputs.put("timepoints_in_flight", timepoints_in_flight)
+    inputs.put("fuse", fuse)
+    inputs.put("roi_list", "")
+    inputs.put("export_type", export_type)
+    inputs.put("convert_to_ims", convert_to_ims)
+    inputs.put("delete_temp_files", delete_temp_files)
+    inputs.put("email_address", email_address)
+    inputs.put("estimator_cache", estimator_cache)
+    inputs.put("dry_run", dry_run)
+    inputs.put("benchmark_only", False)
+    inputs.put("batch_mode", True)
+
+    return inputs
+
+
+# ─── MAIN CODE ──────────────────────────────────────────────────────────────────
+
+batch_start_time = time.time()
+batch_dir = os.path.dirname(str(input_paths[0])).replace("\\", "/")
+# benchmarks are measured once per drive and tile size and reused by the following
+# datasets, the metadata only when a dataset is processed again
+estimator_cache = batch_dir + "/zeiss-lightsheet-batch_estimates.json"
+
+# all datasets run in this JVM, plugins and readers are only loaded once
+results = []
+for index, input_path in enumerate(input_paths):
+    # every dataset saves its own log, keep them separate
+    IJ.log("\\Clear")
+    IJ.log("Dataset %s of %s: %s" % (index + 1, len(input_paths), input_path))
+    start = time.time()
+    try:
+        scripts.run(
+            pipeline_script, True, get_pipeline_inputs(input_path, estimator_cache)
+        ).get()
+        status = "done"
+    except Exception as error:
+        # keep going, a single broken dataset shouldn't stop the batch
+        status = "failed: " + str(error)
+        IJ.log("Processing failed: " + str(error))
+        IJ.selectWindow("Log")
+        IJ.saveAs("Text", str(input_path) + "_BigStitcher_Failed_Log")
+    results.append((str(input_path), status, round((time.time() - start) / 60.0)))
+
+IJ.log("\\Clear")
+IJ.log("\n~~~ Batch summary ~~~")
+for path, status, minutes in results:
+    IJ.log("%s: %s (%s min)" % (path, status, minutes))
+IJ.log("Estimator cache: " + estimator_cache)
+IJ.log("Total time in minutes: " + str(round((time.time() - batch_start_time) / 60.0)))
+IJ.log("All done")
+IJ.selectWindow("Log")
+IJ.saveAs("Text", batch_dir + "/zeiss-lightsheet-batch_Log")
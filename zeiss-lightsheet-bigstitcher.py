@@ -3,10 +3,17 @@
 #@ File (label="Select first CZI file", description="select only the first czi file")  input_path
 #@ String (label="What reader to use ?", choices={"LightSheet 7 (Zen tiling)","LightSheet Z.1 / 7 (Tile scan macro)"}, style="listBox") reader
 #@ Boolean (label="Automatically select best illumination side", description="discard the other illumination", value=false) autoselect_illuminations
+#@ Integer (label="Register while resaving (timepoints in flight)", description="calculate the shifts of each timepoint as soon as it is resaved, while up to this many timepoints are resaved ahead. 0 = resave all timepoints first", min=0, max=16, value=2) timepoints_in_flight
 #@ Boolean (label="Fuse image", description="save dataset as fused xml/tiff images or as h5/xml if size is too large", value=true) fuse
+#@ String (label="Regions of interest", description="fuse only these regions instead of the whole dataset: 'x0,y0,z0,x1,y1,z1' in micron or 'tile=3', optionally with 'c=0,1' and 't=0-2', separated by ';'. empty = skip") roi_list
+#@ String (label="Fused image export", choices={"16-bit","16-bit LZW compressed","8-bit rescaled"}, description="8-bit maps the 0.1 to 99.9 percentiles of each channel to 0-255", style="listBox") export_type
 #@ Boolean (label="Convert fused image to Imaris5", description="convert to fused image to *.ims", value=true) convert_to_ims
 #@ Boolean (label="Delete intermediate files", description="keep only final fused image", value=true) delete_temp_files
 #@ String (label="Send info email to: ", description="empty = skip") email_address
+#@ String (label="Estimator cache", description="json file to reuse the disk throughput of the same drive, the compression benchmark of similar acquisitions and the CZI metadata of files processed before, as used by the batch script. empty = measure every time", value="") estimator_cache
+#@ Boolean (label="Dry run", description="only print the execution plan with cost estimates and save it as *_plan.json, nothing is processed", value=false) dry_run
+#@ Boolean (label="Only benchmark the HDF5 layout", description="measure the disk throughput and compression, then choose pyramid, block sizes and compression for the resave and print them, implies a dry run", value=false) benchmark_only
+#@ Boolean (label="Run by the batch script", description="set by zeiss-lightsheet-batch.py, skips the waits for the garbage collection", visibility=INVISIBLE, value=false) batch_mode
 
 # TODO: include tp range request by default, maybe in two variables, t_start and t_end. Then use them instead of "[All Timepoints]"
 
@@ -20,10 +27,49 @@ import smtplib
 import shutil
 import subprocess
 import sys
+import json
+import re
+import threading
+import Queue
+from collections import OrderedDict, deque
 
 # Imagej imports
-from ij import IJ
-from ij.gui import YesNoCancelDialog
+from ij import IJ, ImagePlus, ImageStack
+from ij.process import ShortProcessor, StackStatistics
+
+# java imports
+import jarray
+from java.io import File, FileOutputStream
+from java.nio import ByteBuffer, ByteOrder
+from java.lang import Class, Runtime, System
+from java.lang.management import ManagementFactory
+from java.security import MessageDigest
+from java.util import ArrayList, HashMap
+from java.util.concurrent import Callable, Executors
+from java.util.zip import Deflater, Inflater
+
+# hdf5 imports to verify the written files
+from ch.systemsx.cisd.hdf5 import HDF5Factory
+
+# bigdataviewer imports to link the H5 of single timepoints
+from bdv.export import ExportMipmapInfo, WriteSequenceToHdf5
+from bdv.img.hdf5 import Hdf5ImageLoader, Partition
+
+# spim data imports to keep decoded views in memory
+from mpicbg.spim.data.sequence import ImgLoader, SetupImgLoader
+
+# imglib2 imports
+from net.imglib2 import FinalInterval
+from net.imglib2.converter import Converters, RealUnsignedShortConverter
+from net.imglib2.img.planar import PlanarImgFactory, PlanarImgs
+from net.imglib2.type.numeric.integer import UnsignedShortType
+from net.imglib2.util import ImgUtil, Intervals
+from net.imglib2.view import Views
+
+# multiview reconstruction imports to fuse regions of interest
+from net.preibisch.mvrecon.fiji.spimdata import XmlIoSpimData2
+from net.preibisch.mvrecon.process.boundingbox import BoundingBoxMaximal
+from net.preibisch.mvrecon.process.fusion import FusionTools
 
 # ome imports to parse metadata
 from loci.formats import ImageReader
@@ -39,7 +85,14 @@ import org.w3c.dom.NodeList
 
 from loci.formats.in import ZeissCZIReader, DynamicMetadataOptions, MetadataOptions
 from loci.formats import ImageReader, TileStitcher
+from loci.formats import FormatTools
 from loci.formats import MetadataTools
+from loci.formats.out import OMETiffWriter
+from loci.formats.tiff import TiffParser
+from loci.plugins import BF
+from loci.plugins.in import ImporterOptions
+from ome.units import UNITS
+from ome.units.quantity import Length
 
 # requirements:
 # BigStitcher, Multiview Reconstruction >= 10.2
@@ -129,86 +182,2021 @@ def get_calibration_from_metadata(path_to_image):
     return image_calibration
 
 
-def check_fusion_settings(czi_path):
-    """Check for fusion settings and asks confirmation to user if H5/XML fusion
+def measure_disk_throughput(directory, test_size=256 * 1024 * 1024):
+    """Measure the sequential write throughput of the disk holding a directory
+
+    Parameters
+    ----------
+    directory : str
+        Path to the directory that will receive the intermediate files
+    test_size : int, optional
+        Number of bytes to write for the measurement, by default 256 MB
+
+    Returns
+    -------
+    float
+        Write throughput in bytes per second
+    """
+    test_file = os.path.join(directory, "disk_throughput_test.tmp")
+    block = jarray.zeros(4 * 1024 * 1024, "b")
+
+    start = time.time()
+    stream = FileOutputStream(test_file)
+    try:
+        for _ in range(test_size // len(block)):
+            stream.write(block)
+        # make sure the data actually hits the disk and not only the OS cache
+        stream.getFD().sync()
+    finally:
+        stream.close()
+    duration = max(time.time() - start, 0.001)
+    os.remove(test_file)
+
+    return test_size / duration
+
+
+def choose_fusion_strategy(
+    fused_size,
+    disk_throughput,
+    plane_bytes,
+    slab_depth,
+    free_memory,
+    decoded_size=None,
+    max_hours=48,
+):
+    """Pick the fusion strategy with the lowest predicted cost, without user input
+
+    The predicted cost only accounts for the disk I/O, which is the limiting factor
+    on our workstations. The block-cached fusion streams slabs of the fused volume
+    to TIFF, so its memory use only grows with the XY area of the volume: if fewer
+    planes than a H5 block fit into half of the free memory, every block is read
+    several times, and if not even a single plane fits, the fusion runs virtually
+    on the H5/XML. Datasets whose decoded views fit into half of the free memory
+    skip the H5 resave and are fused from memory.
+
+    Parameters
+    ----------
+    fused_size : float
+        Estimated size of the complete fused output in bytes
+    disk_throughput : float
+        Write throughput of the temp folder in bytes per second
+    plane_bytes : float
+        Estimated size of a single fused 16-bit plane in bytes
+    slab_depth : int
+        Number of planes of a H5 block
+    free_memory : float
+        Free memory in IJ in bytes
+    decoded_size : float, optional
+        Size of all decoded views, see `get_decoded_size`, by default None to not
+        consider the in-memory fusion
+    max_hours : int, optional
+        Maximum predicted duration before falling back to a downsampled fusion, by
+        default 48
+
+    Returns
+    -------
+    dict
+        The chosen strategy with its name, "ram_handling", "fuse_tiff",
+        "downsampling" and "predicted_minutes", as well as the costs of all
+        candidates that were evaluated
+    """
+    throughput_min = disk_throughput * 60.0
+    memory = free_memory / 2
+
+    # reading the h5 in traversal order and writing the fused TIFF, thinner slabs
+    # than the h5 blocks read every block several times
+    candidates = []
+    planes_per_slab = get_slab_depth(plane_bytes, slab_depth, memory)
+    if planes_per_slab:
+        candidates.append(
+            {
+                "name": "Block-cached H5",
+                "ram_handling": "Block-cached",
+                "fuse_tiff": True,
+                "downsampling": 1,
+                "predicted_minutes": (1 + float(slab_depth) / planes_per_slab)
+                * fused_size
+                / throughput_min,
+            }
+        )
+    # no intermediate, but random access into the h5 is roughly 10 times slower
+    candidates.append(
+        {
+            "name": "Virtual",
+            "ram_handling": "Virtual",
+            "fuse_tiff": False,
+            "downsampling": 1,
+            "predicted_minutes": 11 * fused_size / throughput_min,
+        }
+    )
+    # decoded views kept in memory, only the fused TIFF is written
+    if planes_per_slab and decoded_size and decoded_size < memory:
+        candidates.append(
+            {
+                "name": "In-memory",
+                "ram_handling": "In-memory",
+                "fuse_tiff": True,
+                "downsampling": 1,
+                "predicted_minutes": fused_size / throughput_min,
+            }
+        )
+
+    strategy = min(candidates, key=lambda x: x["predicted_minutes"])
+
+    factor = 2
+    planes_per_slab = get_slab_depth(plane_bytes / factor**2, slab_depth, memory)
+    if strategy["predicted_minutes"] > max_hours * 60 and planes_per_slab:
+        # downsampling only shrinks the fused output, the inputs are read in full
+        downsampled = {
+            "name": "Downsampled",
+            "ram_handling": "Block-cached",
+            "fuse_tiff": True,
+            "downsampling": factor,
+            "predicted_minutes": (float(slab_depth) / planes_per_slab + 1.0 / factor**3)
+            * fused_size
+            / throughput_min,
+        }
+        candidates.append(downsampled)
+        strategy = min(candidates, key=lambda x: x["predicted_minutes"])
+
+    strategy = dict(strategy)
+    strategy["candidates"] = [
+        {"name": x["name"], "predicted_minutes": round(x["predicted_minutes"], 1)}
+        for x in candidates
+    ]
+
+    return strategy
+
+
+def get_czi_files(first_czi):
+    """List the CZI files of an acquisition
+
+    Zen splits large acquisitions into "<name>.czi", "<name>(1).czi",
+    "<name>(2).czi" and so on. Other acquisitions in the same folder, like
+    "<name>0.czi" next to "<name>.czi", are not included.
+
+    Parameters
+    ----------
+    first_czi : str
+        Path to the first CZI file
+
+    Returns
+    -------
+    list of str
+        Paths of all CZI files of the acquisition
+    """
+    folder = os.path.dirname(first_czi)
+    name = os.path.basename(first_czi)[: -len(".czi")]
+    pattern = re.compile(re.escape(name) + r"(\(\d+\))?\.czi$")
+
+    return [folder + "/" + x for x in sorted(os.listdir(folder)) if pattern.match(x)]
+
+
+def get_czi_info(czi_path):
+    """Read the dimensions of a dataset from the metadata of its first CZI file
 
     Parameters
     ----------
     czi_path : str
-        Path to the CZI file
+        Path to the first CZI file
+
+    Returns
+    -------
+    dict
+        Number of timepoints ("nbr_tp"), channels ("nbr_chnl") and series
+        ("nbr_series", i.e. tiles, angles and illuminations), the size of a single
+        tile ("size_x", "size_y", "size_z"), its bytes per pixel ("bytes_per_px")
+        and the physical voxel size ("voxel_size", None if not available)
+    """
+    reader = ZeissCZIReader()
+    m = DynamicMetadataOptions()
+    m.setBoolean(ZeissCZIReader.ALLOW_AUTOSTITCHING_KEY, False)
+    m.setBoolean(ZeissCZIReader.RELATIVE_POSITIONS_KEY, True)
+    reader.setMetadataOptions(m)
+    omeMeta = MetadataTools.createOMEXMLMetadata()
+    reader.setMetadataStore(omeMeta)
+    reader.setId(str(czi_path))
+
+    try:
+        voxel_size = [
+            omeMeta.getPixelsPhysicalSizeX(0).value(),
+            omeMeta.getPixelsPhysicalSizeY(0).value(),
+            omeMeta.getPixelsPhysicalSizeZ(0).value(),
+        ]
+    except AttributeError:
+        # one of the physical sizes is missing in the metadata
+        voxel_size = None
+
+    czi_info = {
+        "nbr_tp": omeMeta.getTimestampAnnotationCount() + 1,
+        "nbr_chnl": omeMeta.getChannelCount(0),
+        "nbr_series": reader.getSeriesCount(),
+        "size_x": reader.getSizeX(),
+        "size_y": reader.getSizeY(),
+        "size_z": reader.getSizeZ(),
+        "bytes_per_px": FormatTools.getBytesPerPixel(reader.getPixelType()),
+        "voxel_size": voxel_size,
+    }
+    reader.close()
+
+    return czi_info
+
+
+def check_fusion_settings(
+    raw_size, czi_info, disk_throughput, slab_depth, decoded_size=None
+):
+    """Check for fusion settings and choose the fusion strategy non-interactively
+
+    Parameters
+    ----------
+    raw_size : int
+        Size of all CZI files of the acquisition in bytes
+    czi_info : dict
+        Dimensions of the dataset, see `get_czi_info`
+    disk_throughput : float
+        Write throughput of the temp folder in bytes per second
+    slab_depth : int
+        Number of planes of a H5 block
+    decoded_size : float, optional
+        Size of all decoded views, by default None to always resave to H5
+
+    Returns
+    -------
+    dict
+        The fusion strategy, see `choose_fusion_strategy`
+    """
+    # check the file size of the file to be fused and compare to the available RAM
+    # h5_filesize = os.path.getsize(export_path_temp + ".h5")
+    # summed over all CZI files, multi-file acquisitions are fused as a whole
+    h5_filesize = raw_size / 2
+    free_memory = get_free_memory()
+    # the fused plane is at most as large as all tiles next to each other
+    plane_bytes = czi_info["size_x"] * czi_info["size_y"] * czi_info["nbr_series"] * 2
+
+    print("h5 filesize " + convert_bytes(h5_filesize))
+    print("fused plane size " + convert_bytes(plane_bytes))
+    print("free memory in ij " + convert_bytes(free_memory))
+    print("disk throughput " + convert_bytes(disk_throughput) + "/s")
+
+    # TODO: include in below calculation t_end, since only one t is fused at a time.
+    strategy = choose_fusion_strategy(
+        h5_filesize / downsampling,
+        disk_throughput,
+        plane_bytes,
+        slab_depth,
+        free_memory,
+        decoded_size,
+    )
+    strategy["free_memory"] = free_memory
+    strategy["fused_size"] = h5_filesize
+    strategy["plane_bytes"] = plane_bytes
+    strategy["disk_throughput"] = disk_throughput
+
+    IJ.log(
+        "Fusion strategy: %s (%s, predicted %.1f min)"
+        % (strategy["name"], strategy["ram_handling"], strategy["predicted_minutes"])
+    )
+    for candidate in strategy["candidates"]:
+        print(
+            "fusion candidate %s: %s min"
+            % (candidate["name"], candidate["predicted_minutes"])
+        )
+
+    return strategy
+
+
+def write_json(path, content):
+    """Write a dictionary to a json file
+
+    Parameters
+    ----------
+    path : str
+        Path of the json file
+    content : dict
+        Content to be written
+    """
+    with open(path, "w") as json_file:
+        json.dump(content, json_file, indent=4, sort_keys=True)
+
+
+def read_json(path):
+    """Read a dictionary from a json file
+
+    Parameters
+    ----------
+    path : str
+        Path of the json file
+
+    Returns
+    -------
+    dict
+        Content of the file, empty if it doesn't exist yet
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as json_file:
+        return json.load(json_file)
+
+
+def get_acquisition_key(czi_info):
+    """Get a key shared by acquisitions whose raw data compresses alike
+
+    The compression benchmark only reads planes of the first tile, so acquisitions
+    with the same tile size and pixel type share it, whatever their number of
+    tiles, channels and timepoints.
+
+    Parameters
+    ----------
+    czi_info : dict
+        Dimensions of the dataset, see `get_czi_info`
+
+    Returns
+    -------
+    str
+        The key
+    """
+    keys = ["size_x", "size_y", "bytes_per_px"]
+
+    return "_".join(str(czi_info[key]) for key in keys)
+
+
+def get_stack_histogram(imp):
+    """Get the full 16-bit histogram of a (virtual) stack
+
+    The stack is read plane by plane and the histogram is computed in Java, so this
+    also works on stacks that do not fit in memory.
+
+    Parameters
+    ----------
+    imp : ij.ImagePlus
+        16-bit image, can be a virtual stack
+
+    Returns
+    -------
+    list of int
+        Number of pixels for each of the 65536 intensity values
+    """
+    stats = StackStatistics(imp, 65536, 0, 65536)
+
+    return list(stats.histogram)
+
+
+def get_sampled_input_histograms(czi_path, nbr_chnl, sample_step=8):
+    """Get the 16-bit histograms of the raw data by sampling every nth plane
+
+    Parameters
+    ----------
+    czi_path : str
+        Path to the first CZI file
+    nbr_chnl : int
+        Number of channels
+    sample_step : int, optional
+        Only every nth z-plane of every nth tile is read, by default 8
+
+    Returns
+    -------
+    dict
+        Histogram for each channel index
+    """
+    reader = ImageReader()
+    reader.setId(str(czi_path))
+    nbr_series = reader.getSeriesCount()
+    reader.close()
+
+    histograms = {}
+    for series in range(0, nbr_series, sample_step):
+        options = ImporterOptions()
+        options.setId(str(czi_path))
+        options.setVirtual(True)
+        options.setSplitChannels(True)
+        options.setOpenAllSeries(False)
+        # series 0 is on by default, it would be opened with every other series
+        options.clearSeries()
+        options.setSeriesOn(series, True)
+        options.setZStep(series, sample_step)
+        for chnl, imp in enumerate(BF.openImagePlus(options)):
+            if chnl < nbr_chnl:
+                histograms[chnl] = add_histograms(
+                    histograms.get(chnl), get_stack_histogram(imp)
+                )
+            imp.close()
+
+    return histograms
+
+
+def add_histograms(histogram_a, histogram_b):
+    """Add two histograms bin by bin
+
+    Parameters
+    ----------
+    histogram_a : list of int or None
+        First histogram, None is treated as an empty histogram
+    histogram_b : list of int
+        Second histogram
+
+    Returns
+    -------
+    list of int
+        The summed histogram
+    """
+    if histogram_a is None:
+        return histogram_b
+
+    return [a + b for a, b in zip(histogram_a, histogram_b)]
+
+
+def get_percentiles(histogram, percentiles=(0.1, 1, 50, 99, 99.9)):
+    """Get intensity percentiles from a 16-bit histogram
+
+    Parameters
+    ----------
+    histogram : list of int
+        Number of pixels for each intensity value
+    percentiles : tuple of float, optional
+        Percentiles to look up, by default (0.1, 1, 50, 99, 99.9)
+
+    Returns
+    -------
+    dict
+        Intensity value for each percentile, as well as "min" and "max"
+    """
+    total = float(sum(histogram))
+    nonzero = [value for value, count in enumerate(histogram) if count]
+    result = {
+        "min": nonzero[0] if nonzero else 0,
+        "max": nonzero[-1] if nonzero else 0,
+    }
+
+    remaining = sorted(percentiles)
+    cumulative = 0
+    for value, count in enumerate(histogram):
+        cumulative += count
+        while remaining and cumulative >= total * remaining[0] / 100.0:
+            result[str(remaining.pop(0))] = value
+        if not remaining:
+            break
+
+    return result
+
+
+def get_fused_tiffs(fused_dir):
+    """List the fused TIFFs of a fusion run with their timepoint and channel
+
+    Parameters
+    ----------
+    fused_dir : str
+        Folder the fused XML/TIFF project was written to
+
+    Returns
+    -------
+    list of tuple
+        (path, timepoint, channel) for each fused TIFF
+    """
+    fused_tiffs = []
+    for path in sorted(glob.glob(fused_dir + "/fused_tp_*_ch_*.tif")):
+        match = re.search(r"fused_tp_(\d+)_ch_(\d+)\.tif$", path)
+        fused_tiffs.append((path, int(match.group(1)), int(match.group(2))))
+
+    return fused_tiffs
+
+
+def export_fused_tiff(tiff_path, display_range, voxel_size):
+    """Rewrite a fused 16-bit TIFF plane by plane as LZW compressed 8-bit TIFF
+
+    The file is written next to the original one and replaces it when done, so
+    the file names expected by ImarisConvert do not change.
+
+    Parameters
+    ----------
+    tiff_path : str
+        Path to the fused TIFF
+    display_range : tuple of int
+        Intensities mapped to 0 and 255
+    voxel_size : list of float
+        Voxel size of the fused volume in micron, as returned by `fuse_to_tiff`,
+        ImageJ doesn't read it from the OME-XML of the fused TIFF
+
+    Returns
+    -------
+    dict
+        Checksum of the written pixel data and the shape of the written stack
+    """
+    digest = MessageDigest.getInstance("SHA-256")
+    imp = IJ.openVirtual(tiff_path)
+    stack = imp.getStack()
+    width, height, nbr_planes = imp.getWidth(), imp.getHeight(), stack.getSize()
+
+    omeMeta = MetadataTools.createOMEXMLMetadata()
+    MetadataTools.populateMetadata(
+        omeMeta,
+        0,
+        None,
+        True,
+        "XYZCT",
+        "uint8",
+        width,
+        height,
+        nbr_planes,
+        1,
+        1,
+        1,
+    )
+    omeMeta.setPixelsPhysicalSizeX(Length(voxel_size[0], UNITS.MICROMETER), 0)
+    omeMeta.setPixelsPhysicalSizeY(Length(voxel_size[1], UNITS.MICROMETER), 0)
+    omeMeta.setPixelsPhysicalSizeZ(Length(voxel_size[2], UNITS.MICROMETER), 0)
+
+    export_path = tiff_path.replace(".tif", "_export.tif")
+    writer = OMETiffWriter()
+    writer.setMetadataRetrieve(omeMeta)
+    writer.setBigTiff(True)
+    writer.setCompression(OMETiffWriter.COMPRESSION_LZW)
+    writer.setId(export_path)
+    try:
+        for plane in range(nbr_planes):
+            ip = stack.getProcessor(plane + 1)
+            ip.setMinAndMax(display_range[0], display_range[1])
+            plane_bytes = get_plane_bytes(ip.convertToByte(True))
+            digest.update(plane_bytes)
+            writer.saveBytes(plane, plane_bytes)
+    finally:
+        writer.close()
+        imp.close()
+
+    os.remove(tiff_path)
+    os.rename(export_path, tiff_path)
+
+    return {
+        "checksum": get_hex_digest(digest),
+        "checksum_of": "pixel data",
+        "width": width,
+        "height": height,
+        "planes": nbr_planes,
+        "bytes_per_px": 1,
+    }
+
+
+def get_plane_bytes(ip):
+    """Get the pixels of an 8-bit or 16-bit plane as little endian bytes
+
+    Parameters
+    ----------
+    ip : ij.process.ImageProcessor
+        The plane
+
+    Returns
+    -------
+    byte[]
+        The raw pixel data
+    """
+    pixels = ip.getPixels()
+    if ip.getBitDepth() == 8:
+        return pixels
+
+    buffer = ByteBuffer.allocate(len(pixels) * 2)
+    buffer.order(ByteOrder.LITTLE_ENDIAN).asShortBuffer().put(pixels)
+
+    return buffer.array()
+
+
+def get_hex_digest(digest):
+    """Get the hexadecimal representation of a MessageDigest
+
+    Parameters
+    ----------
+    digest : java.security.MessageDigest
+        Digest that all data has been fed into
+
+    Returns
+    -------
+    str
+        The checksum as hex string
+    """
+    return "".join("%02x" % (byte & 0xFF) for byte in digest.digest())
+
+
+def get_fused_dimensions(xml_path):
+    """Get the size of the fused volumes from the fused XML project
+
+    Parameters
+    ----------
+    xml_path : str
+        Path to the XML project written by the fusion
+
+    Returns
+    -------
+    list of int
+        Size of the fused volumes in x, y and z
+    """
+    dom = DocumentBuilderFactory.newInstance().newDocumentBuilder().parse(xml_path)
+    view_setup = dom.getElementsByTagName("ViewSetup").item(0)
+    size = view_setup.getElementsByTagName("size").item(0).getTextContent()
+
+    return [int(x) for x in size.split()]
+
+
+def verify_hdf5_datasets(h5_path, dataset_paths, expected_dims, allow_padding=False):
+    """Check that an HDF5 file can be opened and contains complete datasets
+
+    Parameters
+    ----------
+    h5_path : str
+        Path to the HDF5 (or Imaris5) file
+    dataset_paths : list of str
+        Datasets that need to be present
+    expected_dims : list of int
+        Expected size in x, y and z
+    allow_padding : bool, optional
+        Whether datasets may be larger than expected, as Imaris pads them to full
+        chunks, by default False
+
+    Returns
+    -------
+    list of str
+        Problems found, empty if the file is complete
+    """
+    problems = []
+    try:
+        reader = HDF5Factory.openForReading(h5_path)
+    except Exception as error:
+        return ["%s can't be opened: %s" % (h5_path, error)]
+
+    try:
+        # HDF5 stores the dimensions as z, y, x
+        expected = list(reversed(expected_dims))
+        for dataset_path in dataset_paths:
+            if not reader.object().exists(dataset_path):
+                problems.append("%s is missing in %s" % (dataset_path, h5_path))
+                continue
+            dims = list(
+                reader.object().getDataSetInformation(dataset_path).getDimensions()
+            )
+            if allow_padding:
+                complete = all(d >= e for d, e in zip(dims, expected))
+            else:
+                complete = dims == expected
+            if not complete:
+                problems.append("%s in %s has shape %s" % (dataset_path, h5_path, dims))
+    finally:
+        reader.close()
+
+    return problems
+
+
+def verify_tiff(tiff_path, expected_dims, bytes_per_px, compressed=False):
+    """Check that a TIFF on disk is complete, reading only its header and IFDs
+
+    Parameters
+    ----------
+    tiff_path : str
+        Path to the TIFF
+    expected_dims : list of int
+        Expected size in x, y and z
+    bytes_per_px : int
+        Bytes per pixel of the written data
+    compressed : bool, optional
+        Whether the planes are compressed, in which case the file size can't be
+        checked, by default False
+
+    Returns
+    -------
+    list of str
+        Problems found, empty if the file is complete
+    """
+    if not os.path.exists(tiff_path):
+        return [tiff_path + " was not written"]
+
+    width, height, planes = expected_dims
+    problems = []
+    try:
+        parser = TiffParser(tiff_path)
+    except Exception as error:
+        return ["%s can't be opened: %s" % (tiff_path, error)]
+
+    try:
+        nbr_ifds = len(parser.getIFDOffsets())
+        if nbr_ifds != planes:
+            problems.append("%s has %s of %s planes" % (tiff_path, nbr_ifds, planes))
+        ifd = parser.getFirstIFD()
+        shape = [ifd.getImageWidth(), ifd.getImageLength()]
+        if shape != [width, height]:
+            problems.append("%s has planes of %s" % (tiff_path, shape))
+    finally:
+        parser.getStream().close()
+
+    size = os.path.getsize(tiff_path)
+    if not compressed and size < width * height * planes * bytes_per_px:
+        problems.append("%s is truncated to %s" % (tiff_path, convert_bytes(size)))
+
+    return problems
+
+
+def get_directory_size(path):
+    """Get the total size of all files in a directory tree
+
+    Parameters
+    ----------
+    path : str
+        Path to the directory
+
+    Returns
+    -------
+    int
+        Size in bytes, 0 if the directory doesn't exist
+    """
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # files can disappear while a plugin is writing
+                pass
+
+    return size
+
+
+def get_process_io():
+    """Get the bytes read and written by this process so far
+
+    Only available on Linux, where the counters are read from /proc/self/io.
+
+    Returns
+    -------
+    tuple of int or None
+        Bytes read and written, None if not available
+    """
+    try:
+        with open("/proc/self/io") as io_file:
+            counters = dict(line.split(": ") for line in io_file.read().splitlines())
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (IOError, KeyError, ValueError):
+        return None
+
+
+def get_windows_process_io_rates():
+    """Get the current read and write rates of this process on Windows
+
+    The rates are read from the process performance counters, which are available
+    without admin rights and, unlike the disk counters, include the traffic to
+    network shares.
+
+    Returns
+    -------
+    tuple of float or None
+        Bytes read and written per second, None if not available
+    """
+    if not System.getProperty("os.name").startswith("Windows"):
+        return None
+
+    pid = ManagementFactory.getRuntimeMXBean().getName().split("@")[0]
+    command = (
+        "Get-CimInstance Win32_PerfFormattedData_PerfProc_Process "
+        "-Filter 'IDProcess=%s' | ForEach-Object { [string]$_.IOReadBytesPersec + "
+        "' ' + $_.IOWriteBytesPersec }" % pid
+    )
+    try:
+        output = subprocess.check_output(
+            ["powershell", "-NoProfile", "-Command", command]
+        )
+        read_rate, write_rate = output.split()
+        return float(read_rate), float(write_rate)
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return None
+
+
+class StageMonitor(threading.Thread):
+    """Background thread sampling JVM and I/O statistics during long IJ.run stages
+
+    Every few seconds while a stage is active, the heap usage, GC time, thread count,
+    process CPU load and the read/write throughput are appended to a tab separated
+    time series file. A status line with the current stage, the write throughput and
+    the projected completion is shown in the ImageJ status bar.
+    The throughput is taken from the I/O counters of this process, on Linux from
+    /proc and on Windows from its performance counters; if neither is available,
+    the write throughput falls back to the growth of the output folder.
+    """
+
+    columns = [
+        "time",
+        "stage",
+        "heap_used_mb",
+        "heap_max_mb",
+        "gc_ms",
+        "threads",
+        "cpu_load",
+        "read_mb_s",
+        "write_mb_s",
+        "output_mb",
+        "eta_min",
+    ]
+
+    def __init__(self, log_path, interval=5.0):
+        threading.Thread.__init__(self, name="StageMonitor")
+        self.daemon = True
+        self.log_path = log_path
+        self.interval = interval
+        self.stage = None
+        self.output_dir = None
+        self.expected_bytes = None
+        self.stopped = threading.Event()
+
+        with open(self.log_path, "w") as log_file:
+            log_file.write("\t".join(self.columns) + "\n")
+
+    def start_stage(self, stage, output_dir=None, expected_bytes=None):
+        self.output_dir = output_dir
+        self.expected_bytes = expected_bytes
+        self.stage_start_size = get_directory_size(output_dir) if output_dir else 0
+        self.stage_start_time = time.time()
+        self.stage = stage
+
+    def end_stage(self):
+        self.stage = None
+        IJ.showStatus("")
+
+    def stop(self):
+        self.stopped.set()
+
+    def get_gc_time(self):
+        return sum(
+            bean.getCollectionTime()
+            for bean in ManagementFactory.getGarbageCollectorMXBeans()
+        )
+
+    def get_cpu_load(self):
+        try:
+            return ManagementFactory.getOperatingSystemMXBean().getProcessCpuLoad()
+        except Exception:
+            # only available on HotSpot based JVMs
+            return -1
+
+    def run(self):
+        last_time = time.time()
+        last_gc = self.get_gc_time()
+        last_io = get_process_io()
+        last_size = None
+
+        while not self.stopped.wait(self.interval):
+            now = time.time()
+            elapsed = max(now - last_time, 0.001)
+            gc_time = self.get_gc_time()
+            io = get_process_io()
+            stage = self.stage
+
+            if stage is None:
+                last_time, last_gc, last_io, last_size = now, gc_time, io, None
+                continue
+
+            read_rate = write_rate = -1
+            if io and last_io:
+                read_rate = (io[0] - last_io[0]) / elapsed / 1024**2
+                write_rate = (io[1] - last_io[1]) / elapsed / 1024**2
+            elif io is None:
+                # only queried while a stage is active, it starts a process
+                rates = get_windows_process_io_rates()
+                if rates:
+                    read_rate, write_rate = [x / 1024**2 for x in rates]
+
+            output_mb = eta_min = -1
+            if self.output_dir:
+                size = get_directory_size(self.output_dir)
+                output_mb = (size - self.stage_start_size) / 1024.0**2
+                if last_size is not None and write_rate < 0:
+                    write_rate = (size - last_size) / elapsed / 1024**2
+                last_size = size
+                if self.expected_bytes and output_mb > 0:
+                    stage_rate = output_mb / (now - self.stage_start_time)
+                    remaining = self.expected_bytes / 1024.0**2 - output_mb
+                    eta_min = max(remaining, 0) / stage_rate / 60.0
+
+            runtime = Runtime.getRuntime()
+            sample = [
+                time.strftime("%Y-%m-%d %H:%M:%S"),
+                stage,
+                (runtime.totalMemory() - runtime.freeMemory()) / 1024**2,
+                runtime.maxMemory() / 1024**2,
+                gc_time - last_gc,
+                ManagementFactory.getThreadMXBean().getThreadCount(),
+                "%.2f" % self.get_cpu_load(),
+                "%.1f" % read_rate,
+                "%.1f" % write_rate,
+                "%.0f" % output_mb,
+                "%.1f" % eta_min,
+            ]
+            with open(self.log_path, "a") as log_file:
+                log_file.write("\t".join(str(x) for x in sample) + "\n")
+
+            status = "%s: %.1f MB/s written" % (stage, write_rate)
+            if eta_min >= 0:
+                status += ", ~%.0f min remaining" % eta_min
+            IJ.showStatus(status)
+
+            last_time, last_gc, last_io = now, gc_time, io
+
+
+def benchmark_compression(czi_path, nbr_planes=16):
+    """Measure how well and how fast raw planes compress and decompress with deflate
+
+    The planes are sampled evenly from the first tile of the first CZI file and
+    compressed with the same deflate level HDF5 uses by default, then decompressed
+    again.
+
+    Parameters
+    ----------
+    czi_path : str
+        Path to the first CZI file
+    nbr_planes : int, optional
+        Number of planes to compress, by default 16
+
+    Returns
+    -------
+    dict
+        Compressed size relative to the raw size ("ratio"), the single thread
+        deflate throughput ("throughput") and inflate throughput
+        ("inflate_throughput") in bytes per second of raw data
+    """
+    reader = ZeissCZIReader()
+    m = DynamicMetadataOptions()
+    m.setBoolean(ZeissCZIReader.ALLOW_AUTOSTITCHING_KEY, False)
+    reader.setMetadataOptions(m)
+    reader.setId(str(czi_path))
+    step = max(1, reader.getSizeZ() // nbr_planes)
+    planes = [
+        reader.openBytes(reader.getIndex(z, 0, 0))
+        for z in range(0, reader.getSizeZ(), step)[:nbr_planes]
+    ]
+    reader.close()
+
+    raw_bytes = compressed_bytes = 0
+    compressed = []
+    start = time.time()
+    for plane in planes:
+        # incompressible data grows by a few bytes per block at most
+        buffer = jarray.zeros(len(plane) + 1024, "b")
+        size = 0
+        deflater = Deflater(6)
+        deflater.setInput(plane)
+        deflater.finish()
+        while not deflater.finished():
+            size += deflater.deflate(buffer, size, len(buffer) - size)
+        deflater.end()
+        compressed.append((buffer, size))
+        raw_bytes += len(plane)
+        compressed_bytes += size
+    duration = max(time.time() - start, 0.001)
+
+    output = jarray.zeros(len(planes[0]), "b")
+    start = time.time()
+    for buffer, size in compressed:
+        inflater = Inflater()
+        inflater.setInput(buffer, 0, size)
+        while not inflater.finished():
+            inflater.inflate(output)
+        inflater.end()
+    inflate_duration = max(time.time() - start, 0.001)
+
+    return {
+        "ratio": float(compressed_bytes) / raw_bytes,
+        "throughput": raw_bytes / duration,
+        "inflate_throughput": raw_bytes / inflate_duration,
+    }
+
+
+def choose_hdf5_layout(czi_info, compression, disk_throughput, raw_size):
+    """Choose pyramid levels, block sizes and compression for the HDF5 resave
+
+    Every level halves x and y, z is only halved once the xy pixel size caught up
+    with the z spacing. Blocks are chosen to cover a roughly isotropic physical
+    volume of 16k pixels, which is what the phase correlation and the fusion read.
+    Compression is used when writing and reading the smaller file is faster than
+    writing and reading the raw data, given the measured disk, deflate and inflate
+    throughput. The HDF5 library runs its filters in the thread that writes or
+    reads, so compression and decompression are modelled as single threaded and
+    add up with the disk I/O.
+
+    Parameters
+    ----------
+    czi_info : dict
+        Dimensions of the dataset, see `get_czi_info`
+    compression : dict
+        Deflate benchmark, see `benchmark_compression`
+    disk_throughput : float
+        Write throughput of the target volume in bytes per second
+    raw_size : int
+        Size of the raw data in bytes
+
+    Returns
+    -------
+    dict
+        The "subsampling_factors" and "chunk_sizes" of each level, whether to
+        "compress" and the predicted resave duration with and without compression
+    """
+    voxel_size = czi_info["voxel_size"] or [1, 1, 1]
+    size = [czi_info["size_x"], czi_info["size_y"], czi_info["size_z"]]
+
+    factors = [[1, 1, 1]]
+    while min(size[0], size[1]) / (factors[-1][0] * 2) >= 64:
+        xy, z = factors[-1][0] * 2, factors[-1][2]
+        if voxel_size[0] * xy > voxel_size[2] * z * 1.5:
+            z *= 2
+        factors.append([xy, xy, z])
+
+    chunk_sizes = []
+    for xy, _, z in factors:
+        anisotropy = (voxel_size[2] * z) / (voxel_size[0] * xy)
+        if anisotropy >= 2:
+            chunk_z = max(4, int(16 / anisotropy))
+            chunk_xy = min(64, int((16384 / chunk_z) ** 0.5))
+            chunk_sizes.append([chunk_xy, chunk_xy, chunk_z])
+        else:
+            chunk_sizes.append([16, 16, 16])
+
+    # written once by the resave and read once by registration and fusion
+    raw_minutes = 2 * raw_size / (disk_throughput * 60.0)
+    compressed_minutes = (
+        raw_size / (compression["throughput"] * 60.0)
+        + raw_size / (compression["inflate_throughput"] * 60.0)
+        + 2 * raw_size * compression["ratio"] / (disk_throughput * 60.0)
+    )
+
+    return {
+        "subsampling_factors": factors,
+        "chunk_sizes": chunk_sizes,
+        "compress": compressed_minutes < raw_minutes,
+        "compression_ratio": compression["ratio"],
+        "raw_minutes": raw_minutes,
+        "compressed_minutes": compressed_minutes,
+    }
+
+
+def get_hdf5_layout_options(layout, timepoints_per_partition=1):
+    """Get the options of the "As HDF5" command for a given layout
+
+    Parameters
+    ----------
+    layout : dict
+        The layout, see `choose_hdf5_layout`
+    timepoints_per_partition : int, optional
+        Timepoints written to each partition H5, 0 for a single H5, by default 1
+
+    Returns
+    -------
+    str
+        The mipmap, chunking and compression options
+    """
+
+    def format_levels(levels):
+        return "[{ " + ", ".join("{%d,%d,%d}" % tuple(x) for x in levels) + " }]"
+
+    options = (
+        "manual_mipmap_setup "
+        + "subsampling_factors="
+        + format_levels(layout["subsampling_factors"])
+        + " "
+        + "hdf5_chunk_sizes="
+        + format_levels(layout["chunk_sizes"])
+        + " "
+        + "timepoints_per_partition=%s " % timepoints_per_partition
+        + "setups_per_partition=0 "
+    )
+    if layout["compress"]:
+        options += "use_deflate_compression "
+
+    return options
+
+
+def log_hdf5_layout(layout):
+    """Print the chosen HDF5 layout to the log
+
+    Parameters
+    ----------
+    layout : dict
+        The layout, see `choose_hdf5_layout`
+    """
+    IJ.log("HDF5 subsampling factors: " + str(layout["subsampling_factors"]))
+    IJ.log("HDF5 block sizes: " + str(layout["chunk_sizes"]))
+    IJ.log(
+        "HDF5 deflate compression: %s (ratio %.2f, predicted %.1f min vs %.1f min raw)"
+        % (
+            layout["compress"],
+            layout["compression_ratio"],
+            layout["compressed_minutes"],
+            layout["raw_minutes"],
+        )
+    )
+
+
+def get_pairwise_shifts_options(xml_path, downsampling=None):
+    """Get the options of the "Calculate pairwise shifts" command
+
+    Parameters
+    ----------
+    xml_path : str
+        Path to the project XML
+    downsampling : list of int, optional
+        Downsampling in x, y and z for the phase correlation, by default None to
+        keep the defaults of the command
+
+    Returns
+    -------
+    str
+        The options for phase correlation, averaging channels and illuminations
+    """
+    options = (
+        "select=["
+        + xml_path
+        + "] "
+        + "process_angle=[All angles] "
+        + "process_channel=[All channels] "
+        + "process_illumination=[All illuminations] "
+        + "process_tile=[All tiles] "
+        + "process_timepoint=[All Timepoints] "
+        + "method=[Phase Correlation] "
+        + "channels=[Average Channels] "
+        + "illuminations=[Average Illuminations]"
+    )
+    if downsampling:
+        options += " downsample_in_x=%s downsample_in_y=%s downsample_in_z=%s" % tuple(
+            downsampling
+        )
+
+    return options
+
+
+def get_timepoint_resave_options(xml_path, tp, tp_path, layout):
+    """Get the options of the "As HDF5" command resaving a single timepoint
+
+    Parameters
+    ----------
+    xml_path : str
+        Path to the defined project XML
+    tp : int
+        Id of the timepoint
+    tp_path : str
+        Path of the XML of the resaved timepoint
+    layout : dict
+        The HDF5 layout, see `choose_hdf5_layout`
+
+    Returns
+    -------
+    str
+        The options for the resave of the timepoint into its own XML/H5
+    """
+    return (
+        "select=["
+        + xml_path
+        + "] "
+        + "resave_angle=[All angles] "
+        + "resave_channel=[All channels] "
+        + "resave_illumination=[All illuminations] "
+        + "resave_tile=[All tiles] "
+        + "resave_timepoint=[Single Timepoint (Select from List)] "
+        + "processing_timepoint=[Timepoint %s] " % tp
+        + get_hdf5_layout_options(layout, timepoints_per_partition=0)
+        + "export_path=["
+        + tp_path
+        + "]"
+    )
+
+
+class TimepointResaver(threading.Thread):
+    """Background thread resaving a dataset to HDF5 one timepoint at a time
+
+    Each timepoint is written to its own XML/H5 next to `export_path`. Resaved
+    timepoints are put on the `resaved` queue; at most `window` of them can wait
+    there for their registration, a slot is freed by calling `slots.release()` as
+    soon as a timepoint is taken off the queue. `stop()` ends the thread before the
+    next timepoint, the one being resaved is still finished.
+    """
+
+    def __init__(self, xml_path, export_path, timepoints, layout, window):
+        threading.Thread.__init__(self, name="TimepointResaver")
+        self.daemon = True
+        self.xml_path = xml_path
+        self.export_path = export_path
+        self.timepoints = timepoints
+        self.layout = layout
+        self.slots = threading.Semaphore(window)
+        self.resaved = Queue.Queue()
+        self.stopped = threading.Event()
+
+    def stop(self):
+        """Don't resave any further timepoints"""
+        self.stopped.set()
+        # wake up the thread if it waits for a slot
+        self.slots.release()
+
+    def run(self):
+        for tp in self.timepoints:
+            self.slots.acquire()
+            if self.stopped.is_set():
+                return
+            tp_path = self.export_path.replace(".xml", "_tp%s.xml" % tp)
+            try:
+                IJ.log("Resaving timepoint %s..." % tp)
+                IJ.run(
+                    "As HDF5 ...",
+                    get_timepoint_resave_options(
+                        self.xml_path, tp, tp_path, self.layout
+                    ),
+                )
+            except Exception as error:
+                self.resaved.put((tp, None, error))
+                return
+            self.resaved.put((tp, tp_path, None))
+
+
+def to_int_matrix(rows):
+    """Convert a list of lists to a Java int[][]
+
+    Parameters
+    ----------
+    rows : list of list of int
+        The values
+
+    Returns
+    -------
+    int[][]
+        The Java array
+    """
+    return jarray.array([jarray.array(row, "i") for row in rows], Class.forName("[I"))
+
+
+def merge_timepoint_projects(xml_path, tp_projects, merged_path, layout):
+    """Merge the projects of single timepoints into one partitioned HDF5 project
+
+    The H5 of every timepoint becomes a partition of the merged dataset, linked from
+    a new master H5, so no image data is copied. The pairwise shifts of all
+    timepoints are collected in the merged XML.
+
+    Parameters
+    ----------
+    xml_path : str
+        Path to the defined (not resaved) project XML with all timepoints
+    tp_projects : list of tuple
+        Timepoint id and path of its resaved and registered project XML
+    merged_path : str
+        Path to save the merged project XML to, the master H5 is saved next to it
+    layout : dict
+        The layout the timepoints were resaved with, see `choose_hdf5_layout`
+    """
+    spim_data = XmlIoSpimData2("").load(xml_path)
+    sequence = spim_data.getSequenceDescription()
+
+    setups = HashMap()
+    mipmap_info = HashMap()
+    for setup_id in sequence.getViewSetups().keySet():
+        setups.put(setup_id, setup_id)
+        mipmap_info.put(
+            setup_id,
+            ExportMipmapInfo(
+                to_int_matrix(layout["subsampling_factors"]),
+                to_int_matrix(layout["chunk_sizes"]),
+            ),
+        )
+
+    partitions = ArrayList()
+    for tp, tp_path in tp_projects:
+        tp_data = XmlIoSpimData2("").load(tp_path)
+        spim_data.getStitchingResults().getPairwiseResults().putAll(
+            tp_data.getStitchingResults().getPairwiseResults()
+        )
+        timepoints = HashMap()
+        timepoints.put(tp, tp)
+        partitions.add(Partition(tp_path.replace(".xml", ".h5"), timepoints, setups))
+
+    h5_file = File(merged_path.replace(".xml", ".h5"))
+    WriteSequenceToHdf5.writeHdf5PartitionLinkFile(
+        sequence, mipmap_info, partitions, h5_file
+    )
+    sequence.setImgLoader(Hdf5ImageLoader(h5_file, partitions, sequence))
+    spim_data.setBasePath(File(os.path.dirname(merged_path)))
+    XmlIoSpimData2("").save(spim_data, merged_path)
+
+
+def resave_and_register_by_timepoint(xml_path, merged_path, timepoints, layout, window):
+    """Resave the dataset to HDF5 and calculate the pairwise shifts by timepoint
+
+    While a timepoint is registered, the following ones are already resaved in the
+    background, at most `window` timepoints ahead. The registration of a timepoint
+    only reads its own H5, so it mostly hides behind the I/O bound resave.
+
+    Parameters
+    ----------
+    xml_path : str
+        Path to the defined project XML
+    merged_path : str
+        Path of the resaved project XML with all timepoints
+    timepoints : list of int
+        Timepoint ids in the order to process them
+    layout : dict
+        The HDF5 layout, see `choose_hdf5_layout`
+    window : int
+        Number of resaved timepoints that can wait for their registration
+    """
+    resaver = TimepointResaver(xml_path, merged_path, timepoints, layout, window)
+    resaver.start()
+
+    tp_projects = []
+    try:
+        for _ in timepoints:
+            tp, tp_path, error = resaver.resaved.get()
+            # the next timepoint is resaved while this one is registered
+            resaver.slots.release()
+            if error:
+                raise error
+            IJ.log("Calculating pairwise shifts of timepoint %s..." % tp)
+            IJ.run(
+                "Calculate pairwise shifts ...", get_pairwise_shifts_options(tp_path)
+            )
+            tp_projects.append((tp, tp_path))
+    finally:
+        # if anything fails, no timepoints are resaved in the background anymore
+        resaver.stop()
+        resaver.join()
+
+    IJ.log("Merging %s timepoints into %s" % (len(tp_projects), merged_path))
+    merge_timepoint_projects(xml_path, tp_projects, merged_path, layout)
+
+
+def estimate_io_minutes(read_bytes, write_bytes, disk_throughput):
+    """Estimate the duration of a stage that is limited by disk I/O
+
+    Parameters
+    ----------
+    read_bytes : float
+        Number of bytes read by the stage
+    write_bytes : float
+        Number of bytes written by the stage
+    disk_throughput : float
+        Disk throughput in bytes per second
 
     Returns
     -------
-    bool
-        Bool for fusion
-    str
-        Method of RAM handling
-    bool
-        Bool for TIFF or H5/XML fusion
+    float
+        Estimated duration in minutes
     """
+    return (read_bytes + write_bytes) / (disk_throughput * 60.0)
 
-    # Default values
-    do_fusion = True
-    fuse_tiff = True
 
-    reader = ZeissCZIReader()
-    m = DynamicMetadataOptions()
-    m.setBoolean(ZeissCZIReader.ALLOW_AUTOSTITCHING_KEY, False)
-    m.setBoolean(ZeissCZIReader.RELATIVE_POSITIONS_KEY, True)
-    reader.setMetadataOptions(m)
-    omeMeta = MetadataTools.createOMEXMLMetadata()
-    reader.setMetadataStore(omeMeta)
-    reader.setId(str(czi_path))
+def run_stage(
+    command,
+    options,
+    output_dir=None,
+    expected_bytes=None,
+    estimated_minutes=None,
+    action=None,
+    commands=None,
+):
+    """Run an IJ command while the stage monitor records its statistics
 
-    nbr_tp = omeMeta.getTimestampAnnotationCount() + 1
-    nbr_chnl = omeMeta.getChannelCount(0)
+    Every stage is added to the execution plan. In a dry run the command is only
+    added to the plan, but not executed. Stages implemented in this script pass
+    their function as `action`, which is run instead of the IJ command, and list
+    the IJ commands it runs as `commands`.
 
-    # check the file size of the file to be fused and compare to the available RAM
-    # h5_filesize = os.path.getsize(export_path_temp + ".h5")
-    h5_filesize = os.path.getsize(czi_path) / 2
-    free_memory = get_free_memory()
+    Parameters
+    ----------
+    command : str
+        The IJ command
+    options : str
+        The options of the command
+    output_dir : str, optional
+        Folder the command writes its output to, used for the throughput and
+        the projected completion, by default None
+    expected_bytes : float, optional
+        Expected size of the output, by default None
+    estimated_minutes : float, optional
+        Estimated duration of the stage, by default None
+    action : callable, optional
+        Function to run instead of `IJ.run`, by default None
+    commands : list of tuple, optional
+        (command, options) of every IJ command run by `action`, by default None
 
-    print("h5 filesize " + convert_bytes(h5_filesize))
-    print("free memory in ij " + convert_bytes(free_memory))
+    Returns
+    -------
+    object
+        What `action` returned, None for IJ commands and in a dry run
+    """
+    stage = {
+        "command": command,
+        "options": options,
+        "scripted": action is not None,
+        "commands": commands or [],
+        "output_dir": output_dir,
+        "expected_bytes": expected_bytes,
+        "estimated_minutes": estimated_minutes,
+    }
+    plan.append(stage)
+    if dry_run:
+        return
+
+    start = time.time()
+    monitor.start_stage(command.replace(" ...", ""), output_dir, expected_bytes)
+    try:
+        if action:
+            return action()
+        IJ.run(command, options)
+    finally:
+        monitor.end_stage()
+        stage["minutes"] = (time.time() - start) / 60.0
 
-    # TODO: include in below calculation t_end, since only one t is fused at a time.
-    if free_memory > (6 * h5_filesize / downsampling):
-        ram_handling = "[Precompute Image]"
-    else:
-        ram_handling = "Virtual"
-    print("fusion mode used " + str(ram_handling))
 
-    # if autoselect_illuminations and nbr_ill > 1:
-    #     ill_value = 2
-    # else:
-    #     ill_value = 1
+def print_plan(plan, summary, plan_path):
+    """Print the execution plan to the log and save it as json
 
-    ram_requirement = 2 * h5_filesize / (nbr_tp * nbr_chnl * downsampling)
-    print(ram_requirement)
-    sufficient_ram = ram_requirement < free_memory / 10
+    Parameters
+    ----------
+    plan : list of dict
+        The stages, as recorded by `run_stage`
+    summary : dict
+        Additional information on the job, e.g. the views processed and the fusion
+        strategy
+    plan_path : str
+        Path of the json file
+    """
+    IJ.log("\n~~~ Execution plan ~~~")
+    for key in sorted(summary):
+        IJ.log("%s: %s" % (key, summary[key]))
+
+    total_minutes = 0
+    for number, stage in enumerate(plan):
+        IJ.log("\nStage %d: %s" % (number + 1, stage["command"]))
+        if stage["scripted"]:
+            IJ.log("Run by this script: %s" % stage["options"])
+            for command, options in stage["commands"]:
+                IJ.log('IJ.run("%s", "%s")' % (command, options))
+        else:
+            IJ.log('IJ.run("%s", "%s")' % (stage["command"], stage["options"]))
+        if stage["output_dir"]:
+            expected = stage["expected_bytes"]
+            IJ.log(
+                "Writes to %s (%s)"
+                % (stage["output_dir"], convert_bytes(expected) if expected else "?")
+            )
+        if stage["estimated_minutes"] is not None:
+            IJ.log("Estimated time: %.1f min" % stage["estimated_minutes"])
+            total_minutes += stage["estimated_minutes"]
 
-    if not sufficient_ram:
-        try:
-            yn = YesNoCancelDialog(
-                IJ.getInstance(),
-                "Warning!",
-                (
-                    "File size is too big to use TIFF for fusion\n"
-                    "Fusion will happen using H5/XML which might take weeks. Are you "
-                    "sure you want to do fusion ?\n"
-                    "All steps prior to fusion would still happen, allowing for manual "
-                    "fusion and tile selection."
-                ),
+    IJ.log("\nEstimated total time: %.1f min" % total_minutes)
+    write_json(plan_path, {"summary": summary, "stages": plan})
+
+
+def group_views(spim_data):
+    """Group the present views of a dataset by timepoint and channel
+
+    Parameters
+    ----------
+    spim_data : SpimData2
+        The registered dataset
+
+    Returns
+    -------
+    dict
+        List of ViewIds for each (timepoint, channel) tuple
+    """
+    groups = {}
+    for view in spim_data.getSequenceDescription().getViewDescriptions().values():
+        if not view.isPresent():
+            continue
+        key = (view.getTimePointId(), view.getViewSetup().getChannel().getId())
+        groups.setdefault(key, []).append(view)
+
+    return groups
+
+
+def get_slab_depth(plane_bytes, max_depth, memory):
+    """Get the number of fused planes that can be computed and kept at once
+
+    Parameters
+    ----------
+    plane_bytes : float
+        Size of a single fused 16-bit plane in bytes
+    max_depth : int
+        Number of planes wanted per slab, e.g. the z block size of the H5
+    memory : float
+        Memory available for a slab in bytes
+
+    Returns
+    -------
+    int
+        Number of planes per slab, 0 if a single plane doesn't fit or is larger than
+        the 2 GB a Java array can hold
+    """
+    if plane_bytes > 2**31 - 1:
+        return 0
+
+    return int(min(max_depth, memory // plane_bytes))
+
+
+class SlabTask(Callable):
+    """Compute a slab of consecutive z-planes of a (virtual) fused volume
+
+    The slab is stored plane by plane, so only a single plane has to fit into a
+    Java array.
+    """
+
+    def __init__(self, fused, z_start, z_end):
+        self.fused = fused
+        self.z_start = z_start
+        self.z_end = z_end
+
+    def call(self):
+        width, height = self.fused.dimension(0), self.fused.dimension(1)
+        slab = PlanarImgs.unsignedShorts([width, height, self.z_end - self.z_start])
+        ImgUtil.copy(
+            Views.interval(
+                self.fused,
+                [0, 0, self.z_start],
+                [width - 1, height - 1, self.z_end - 1],
+            ),
+            slab,
+        )
+
+        return [
+            slab.getPlane(z).getCurrentStorageArray()
+            for z in range(self.z_end - self.z_start)
+        ]
+
+
+class CachedSetupImgLoader(SetupImgLoader):
+    """Setup image loader serving the views of one setup from a `ViewCacheImgLoader`"""
+
+    def __init__(self, cache, setup_id, setup_loader):
+        self.cache = cache
+        self.setup_id = setup_id
+        self.setup_loader = setup_loader
+
+    def getImage(self, timepoint_id, *hints):
+        return self.cache.get_view(self.setup_id, timepoint_id, self.setup_loader)
+
+    def getFloatImage(self, timepoint_id, normalize, *hints):
+        return self.setup_loader.getFloatImage(timepoint_id, normalize)
+
+    def getImageType(self):
+        return self.setup_loader.getImageType()
+
+    def getImageSize(self, timepoint_id):
+        return self.setup_loader.getImageSize(timepoint_id)
+
+    def getVoxelSize(self, timepoint_id):
+        return self.setup_loader.getVoxelSize(timepoint_id)
+
+
+class ViewCacheImgLoader(ImgLoader):
+    """Image loader keeping the decoded views of another loader in memory
+
+    Each view is decoded once into a PlanarImg, so views of more than 2^31 pixels
+    can be cached. When the cached views exceed `max_bytes`, the least recently
+    used ones are dropped and decoded again if they are requested later.
+    """
+
+    def __init__(self, loader, max_bytes):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.views = OrderedDict()
+        self.lock = threading.Lock()
+
+    def getSetupImgLoader(self, setup_id):
+        return CachedSetupImgLoader(
+            self, setup_id, self.loader.getSetupImgLoader(setup_id)
+        )
+
+    def get_view(self, setup_id, timepoint_id, setup_loader):
+        key = (setup_id, timepoint_id)
+        with self.lock:
+            view, view_bytes = self.views.pop(key, (None, 0))
+            if view is None:
+                image = setup_loader.getImage(timepoint_id)
+                image_type = setup_loader.getImageType()
+                view = PlanarImgFactory(image_type).create(image)
+                ImgUtil.copy(image, view)
+                view_bytes = (
+                    Intervals.numElements(image) * image_type.getBitsPerPixel() // 8
+                )
+                self.size += view_bytes
+            # re-insert to mark it as most recently used
+            self.views[key] = (view, view_bytes)
+            while self.size > self.max_bytes and len(self.views) > 1:
+                _, (_, evicted_bytes) = self.views.popitem(last=False)
+                self.size -= evicted_bytes
+
+            return view
+
+
+def get_decoded_size(czi_info, raw_size):
+    """Estimate the size of all views of a dataset once they are decoded
+
+    Parameters
+    ----------
+    czi_info : dict
+        Dimensions of the dataset, see `get_czi_info`
+    raw_size : int
+        Size of all CZI files in bytes, as they might be compressed
+
+    Returns
+    -------
+    int
+        Size in bytes of all decoded views
+    """
+    view_size = (
+        czi_info["size_x"]
+        * czi_info["size_y"]
+        * czi_info["size_z"]
+        * czi_info["bytes_per_px"]
+    )
+    decoded_size = (
+        view_size * czi_info["nbr_series"] * czi_info["nbr_chnl"] * czi_info["nbr_tp"]
+    )
+
+    return max(decoded_size, raw_size)
+
+
+def fuse_to_tiff(
+    xml_path, output_dir, downsampling, slab_depth, view_cache_bytes=0, compress=False
+):
+    """Fuse each timepoint and channel of a project into 16-bit TIFFs
+
+    The fused volume is computed in slabs of z-planes, following the z-order the
+    H5 blocks are stored in. While one slab is written, the next ones are already
+    fused by a thread pool; the number of slabs in flight is limited by the free
+    memory. Planes are resampled to the original z-spacing, like the
+    "preserve_original" option of "Fuse dataset ...". The checksum and histogram of
+    each file are computed from the slabs while they are written, so the TIFFs are
+    never read back.
+    Projects that weren't resaved to H5 are fused from their decoded views, kept in
+    memory by a `ViewCacheImgLoader`.
+
+    Parameters
+    ----------
+    xml_path : str
+        Path to the registered project XML
+    output_dir : str
+        Folder to write the fused_tp_<t>_ch_<c>.tif files to
+    downsampling : int
+        Downsampling of the fused volumes
+    slab_depth : int
+        Number of z-planes fused at once, ideally the z block size of the H5
+    view_cache_bytes : int, optional
+        Memory to keep decoded views in, 0 to read them from the image loader of
+        the project, by default 0
+    compress : bool, optional
+        Whether to write LZW compressed TIFFs, by default False
+
+    Returns
+    -------
+    dict
+        The written "files", the "dimensions" and "voxel_size" of the fused volumes
+        in x, y, z, the checksum and shape of every file as "outputs" and the 16-bit
+        "histograms" of every channel
+    """
+    spim_data = XmlIoSpimData2("").load(xml_path)
+    if view_cache_bytes:
+        sequence = spim_data.getSequenceDescription()
+        sequence.setImgLoader(
+            ViewCacheImgLoader(sequence.getImgLoader(), view_cache_bytes)
+        )
+    groups = group_views(spim_data)
+    all_views = [view for views in groups.values() for view in views]
+    bounding_box = BoundingBoxMaximal(all_views, spim_data).estimate(
+        "Full Bounding Box"
+    )
+    voxel_size = all_views[0].getViewSetup().getVoxelSize()
+    unit = min(voxel_size.dimension(d) for d in range(3))
+    z_step = max(1, int(round(voxel_size.dimension(2) / unit / downsampling)))
+
+    threads = Runtime.getRuntime().availableProcessors()
+    executor = Executors.newFixedThreadPool(threads)
+    files = []
+    outputs = {}
+    histograms = {}
+    try:
+        for (tp, chnl), views in sorted(groups.items()):
+            fused = FusionTools.fuseVirtual(
+                spim_data,
+                views,
+                True,  # blending
+                False,  # content based fusion
+                1,  # linear interpolation
+                bounding_box,
+                float(downsampling),
+                None,  # no intensity adjustments
+            )
+            # depending on the version a (image, transform) pair is returned
+            if hasattr(fused, "getA"):
+                fused = fused.getA()
+            fused = Views.subsample(Views.zeroMin(fused), [1, 1, z_step])
+            fused = Converters.convert(
+                fused, RealUnsignedShortConverter(0, 65535), UnsignedShortType()
+            )
+            width, height, depth = [int(fused.dimension(d)) for d in range(3)]
+
+            # slabs are limited to half of the free memory, thinner slabs than the H5
+            # blocks read them several times but keep huge planes feasible
+            plane_bytes = width * height * 2
+            memory = get_free_memory() / 2
+            planes_per_slab = get_slab_depth(plane_bytes, slab_depth, memory)
+            if not planes_per_slab:
+                raise MemoryError(
+                    "a fused plane of %s x %s pixels doesn't fit into %s, "
+                    "increase the memory or the downsampling"
+                    % (width, height, convert_bytes(memory))
+                )
+            # fused slabs waiting to be written
+            slab_bytes = plane_bytes * planes_per_slab
+            window = max(1, min(threads, int(memory / slab_bytes)))
+
+            omeMeta = MetadataTools.createOMEXMLMetadata()
+            MetadataTools.populateMetadata(
+                omeMeta, 0, None, True, "XYZCT", "uint16", width, height, depth, 1, 1, 1
+            )
+            pixel_size = unit * downsampling
+            omeMeta.setPixelsPhysicalSizeX(Length(pixel_size, UNITS.MICROMETER), 0)
+            omeMeta.setPixelsPhysicalSizeY(Length(pixel_size, UNITS.MICROMETER), 0)
+            omeMeta.setPixelsPhysicalSizeZ(
+                Length(pixel_size * z_step, UNITS.MICROMETER), 0
             )
-            if yn.yesPressed():
-                fuse_tiff = False
+
+            tiff_path = "%s/fused_tp_%s_ch_%s.tif" % (output_dir, tp, chnl)
+            IJ.log(
+                "Fusing %s with %s slabs of %s planes in flight..."
+                % (tiff_path, window, planes_per_slab)
+            )
+            writer = OMETiffWriter()
+            writer.setMetadataRetrieve(omeMeta)
+            writer.setBigTiff(True)
+            if compress:
+                writer.setCompression(OMETiffWriter.COMPRESSION_LZW)
+            writer.setId(tiff_path)
+            digest = MessageDigest.getInstance("SHA-256")
+
+            z_starts = range(0, depth, planes_per_slab)
+            pending = deque()
+            try:
+                for z_start in z_starts[:window]:
+                    pending.append(
+                        executor.submit(
+                            SlabTask(
+                                fused, z_start, min(z_start + planes_per_slab, depth)
+                            )
+                        )
+                    )
+                next_slab = window
+                for z_start in z_starts:
+                    planes = pending.popleft().get()
+                    if next_slab < len(z_starts):
+                        z_next = z_starts[next_slab]
+                        pending.append(
+                            executor.submit(
+                                SlabTask(
+                                    fused, z_next, min(z_next + planes_per_slab, depth)
+                                )
+                            )
+                        )
+                        next_slab += 1
+                    slab = ImageStack(width, height)
+                    for plane, pixels in enumerate(planes):
+                        buffer = ByteBuffer.allocate(plane_bytes)
+                        buffer.order(ByteOrder.LITTLE_ENDIAN).asShortBuffer().put(
+                            pixels
+                        )
+                        digest.update(buffer.array())
+                        writer.saveBytes(z_start + plane, buffer.array())
+                        slab.addSlice(ShortProcessor(width, height, pixels, None))
+                    histograms[chnl] = add_histograms(
+                        histograms.get(chnl),
+                        get_stack_histogram(ImagePlus("slab", slab)),
+                    )
+            finally:
+                writer.close()
+            files.append(tiff_path)
+            outputs[tiff_path] = {
+                "checksum": get_hex_digest(digest),
+                "checksum_of": "pixel data",
+                "width": width,
+                "height": height,
+                "planes": depth,
+                "bytes_per_px": 2,
+            }
+    finally:
+        executor.shutdown()
+
+    return {
+        "files": files,
+        "dimensions": [width, height, depth],
+        "voxel_size": [pixel_size, pixel_size, pixel_size * z_step],
+        "outputs": outputs,
+        "histograms": histograms,
+    }
+
+
+def parse_index_list(text):
+    """Parse a list of indices like "0,2-4" into a list of int
+
+    Parameters
+    ----------
+    text : str
+        Comma separated indices or ranges
+
+    Returns
+    -------
+    list of int
+        The indices, e.g. [0, 2, 3, 4]
+    """
+    indices = []
+    for part in text.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            indices += range(int(start), int(end) + 1)
+        else:
+            indices.append(int(part))
+
+    return indices
+
+
+def parse_roi_list(roi_list):
+    """Parse the regions of interest given as script parameter
+
+    Regions are separated by ";". Each region is either given as physical bounding
+    box "x0,y0,z0,x1,y1,z1" (in micron) or as "tile=<index>", optionally followed by
+    the channels "c=0,1" and timepoints "t=0-2" to fuse, e.g.
+    "0,0,0,500,500,200 c=1; tile=3 t=0".
+
+    Parameters
+    ----------
+    roi_list : str
+        The regions of interest
+
+    Returns
+    -------
+    list of dict
+        Each region with its "name", either "min"/"max" or "tile", and the
+        "channels" and "timepoints" (None for all)
+    """
+    rois = []
+    for number, text in enumerate(x for x in roi_list.split(";") if x.strip()):
+        roi = {"name": "roi_%d" % (number + 1), "channels": None, "timepoints": None}
+        for part in text.split():
+            if part.startswith("tile="):
+                roi["tile"] = int(part[len("tile=") :])
+            elif part.startswith("c="):
+                roi["channels"] = parse_index_list(part[len("c=") :])
+            elif part.startswith("t="):
+                roi["timepoints"] = parse_index_list(part[len("t=") :])
             else:
-                do_fusion = False
-        except Exception:
-            # when running headless the above will raise a java.awt.HeadlessException,
-            # so we simply fall back to the same behavior as if "No" was clicked:
-            do_fusion = False
-    return do_fusion, ram_handling, fuse_tiff
+                coordinates = [float(x) for x in part.split(",")]
+                if len(coordinates) != 6:
+                    raise ValueError("Region %s needs 6 coordinates" % text.strip())
+                roi["min"] = coordinates[:3]
+                roi["max"] = coordinates[3:]
+        if "tile" not in roi and "min" not in roi:
+            raise ValueError("Region %s has no bounding box or tile" % text.strip())
+        rois.append(roi)
+
+    return rois
+
+
+def get_roi_interval(roi, spim_data, views):
+    """Get the bounding box of a region of interest in global coordinates
+
+    Parameters
+    ----------
+    roi : dict
+        The region of interest, see `parse_roi_list`
+    spim_data : SpimData2
+        The registered dataset
+    views : list of ViewDescription
+        The present views of the dataset
+
+    Returns
+    -------
+    net.imglib2.Interval
+        The bounding box in the global (pixel) coordinates of the dataset
+    """
+    if "tile" in roi:
+        tile_views = [
+            x for x in views if x.getViewSetup().getTile().getId() == roi["tile"]
+        ]
+        if not tile_views:
+            raise ValueError("Tile %s of %s doesn't exist" % (roi["tile"], roi["name"]))
+        return BoundingBoxMaximal(tile_views, spim_data).estimate(roi["name"])
+
+    # the global coordinates are scaled to the smallest voxel size of the dataset
+    voxel_size = views[0].getViewSetup().getVoxelSize()
+    unit = min(voxel_size.dimension(d) for d in range(3))
+
+    return FinalInterval(
+        [int(round(x / unit)) for x in roi["min"]],
+        [int(round(x / unit)) for x in roi["max"]],
+    )
+
+
+def fuse_rois(xml_path, rois, output_dir, downsampling):
+    """Fuse each region of interest into separate TIFFs in a single batched run
+
+    The dataset is only loaded once and the regions are fused timepoint by
+    timepoint and channel by channel: all regions of a group are fused right after
+    each other, while the H5 blocks of its views are still in the cache of the
+    image loader. Planes are resampled to the original z-spacing, like the full
+    fusion.
+
+    Parameters
+    ----------
+    xml_path : str
+        Path to the registered project XML
+    rois : list of dict
+        The regions of interest, see `parse_roi_list`
+    output_dir : str
+        Folder to write the fused regions to
+    downsampling : int
+        Downsampling of the fused regions
+
+    Returns
+    -------
+    dict
+        Checksum and shape for each written TIFF as "outputs", as used in the
+        manifest, and the TIFFs that failed to save as "problems"
+    """
+    spim_data = XmlIoSpimData2("").load(xml_path)
+    groups = group_views(spim_data)
+    all_views = [view for views in groups.values() for view in views]
+    voxel_size = all_views[0].getViewSetup().getVoxelSize()
+    unit = min(voxel_size.dimension(d) for d in range(3))
+    z_step = max(1, int(round(voxel_size.dimension(2) / unit / downsampling)))
+
+    intervals = [get_roi_interval(roi, spim_data, all_views) for roi in rois]
+    for roi in rois:
+        for tp in roi["timepoints"] or []:
+            for chnl in roi["channels"] or sorted(set(x[1] for x in groups)):
+                if (tp, chnl) not in groups:
+                    IJ.log("No views for %s tp %s ch %s" % (roi["name"], tp, chnl))
+
+    outputs = {}
+    problems = []
+    for (tp, chnl), views in sorted(groups.items()):
+        for roi, interval in zip(rois, intervals):
+            if roi["timepoints"] and tp not in roi["timepoints"]:
+                continue
+            if roi["channels"] and chnl not in roi["channels"]:
+                continue
+            IJ.log("Fusing %s tp %s ch %s..." % (roi["name"], tp, chnl))
+            fused = FusionTools.fuseVirtual(
+                spim_data,
+                views,
+                True,  # blending
+                False,  # content based fusion
+                1,  # linear interpolation
+                interval,
+                float(downsampling),
+                None,  # no intensity adjustments
+            )
+            # depending on the version a (image, transform) pair is returned
+            if hasattr(fused, "getA"):
+                fused = fused.getA()
+            fused = Views.subsample(Views.zeroMin(fused), [1, 1, z_step])
+
+            width, height, depth = [int(fused.dimension(d)) for d in range(3)]
+            target = PlanarImgs.unsignedShorts([width, height, depth])
+            ImgUtil.copy(
+                Converters.convert(
+                    fused,
+                    RealUnsignedShortConverter(0, 65535),
+                    UnsignedShortType(),
+                ),
+                target,
+            )
+
+            digest = MessageDigest.getInstance("SHA-256")
+            stack = ImageStack(width, height)
+            for plane in range(depth):
+                pixels = target.getPlane(plane).getCurrentStorageArray()
+                buffer = ByteBuffer.allocate(len(pixels) * 2)
+                buffer.order(ByteOrder.LITTLE_ENDIAN).asShortBuffer().put(pixels)
+                digest.update(buffer.array())
+                stack.addSlice(ShortProcessor(width, height, pixels, None))
+
+            tiff_path = "%s/%s_tp_%s_ch_%s.tif" % (output_dir, roi["name"], tp, chnl)
+            imp = ImagePlus(os.path.basename(tiff_path), stack)
+            calibration = imp.getCalibration()
+            calibration.pixelWidth = unit * downsampling
+            calibration.pixelHeight = unit * downsampling
+            calibration.pixelDepth = unit * downsampling * z_step
+            calibration.setUnit("micron")
+            if not IJ.saveAsTiff(imp, tiff_path):
+                problems.append(tiff_path + " couldn't be saved")
+            imp.close()
+
+            outputs[tiff_path] = {
+                "checksum": get_hex_digest(digest),
+                "checksum_of": "pixel data",
+                "width": width,
+                "height": height,
+                "planes": depth,
+                "bytes_per_px": 2,
+            }
+
+    return {"outputs": outputs, "problems": problems}
 
 
 def convert_bytes(size):
@@ -268,6 +2256,7 @@ def locate_latest_imaris(paths_to_check=None):
 # ─── MAIN CODE ──────────────────────────────────────────────────────────────────
 
 execution_start_time = time.time()
+dry_run = dry_run or benchmark_only
 downsampling = 1
 # downsampling is not a user variable anymore, I think they all use 1.
 # with the new LS7 tiling, Zen can open the tiled raw data for a sneak peak as well.
@@ -283,326 +2272,661 @@ project_filename = filename.replace(".czi", ".xml")
 project_filename_short = filename.replace(".czi", "")
 project_path = parent_dir + "/" + project_filename
 
-if fuse:
-    fuse, ram_handling, fuse_tiff = check_fusion_settings(input_path)
-
 # add a temp folder
 temp = parent_dir + "/" + filename + "_temp"
-if not os.path.exists(temp):
+if not dry_run and not os.path.exists(temp):
     os.mkdir(temp)
 
-project_path_temp = temp + "/" + project_filename
-export_path_temp = temp + "/" + project_filename_short
-export_path_fused_temp = project_path_temp.replace(".xml", "_fused.xml")
-
-# if no conversion is to ims is selected, save the fused tiff in a new folder next to the raw data instead
-if not convert_to_ims:
-    fused_tiff_dir = parent_dir + "/" + filename + "_fused"
+# stages run (or only planned in a dry run) with their cost estimates
+plan = []
+
+# sample JVM and I/O statistics while the long stages are running
+if not dry_run:
+    monitor = StageMonitor(first_czi + "_monitor.tsv")
+    monitor.start()
+
+# stop the monitor thread also when a stage fails
+try:
+    # the disk throughput is shared by all datasets on the same drive and the
+    # compression benchmark by acquisitions with the same tiles, the metadata is only
+    # reused when the same CZI file is processed again, e.g. when a failed batch is
+    # run again, as dry runs don't write the cache
+    estimates = read_json(estimator_cache) if estimator_cache else {}
+    for section in ["czi_info", "disk_throughput", "compression"]:
+        estimates.setdefault(section, {})
+
+    czi_key = "%s_%s" % (first_czi, os.path.getmtime(first_czi))
+    if czi_key not in estimates["czi_info"]:
+        estimates["czi_info"][czi_key] = get_czi_info(first_czi)
+    czi_info = estimates["czi_info"][czi_key]
+    raw_size = sum(os.path.getsize(czi) for czi in get_czi_files(first_czi))
+    throughput_dir = parent_dir if dry_run else temp
+    # the throughput is a property of the drive, not of the folder
+    drive = os.path.splitdrive(throughput_dir)[0] or os.path.dirname(parent_dir)
+    if drive in estimates["disk_throughput"]:
+        disk_throughput = estimates["disk_throughput"][drive]
+    elif dry_run and not benchmark_only:
+        # a dry run only writes its plan, the write benchmark is left to benchmark_only
+        disk_throughput = 100 * 1024**2
+        IJ.log("Disk throughput not measured in a dry run, assuming 100 MB/s")
+    else:
+        disk_throughput = measure_disk_throughput(throughput_dir)
+        estimates["disk_throughput"][drive] = disk_throughput
 
-    if not os.path.exists(fused_tiff_dir):
-        os.mkdir(fused_tiff_dir)
+    acquisition_key = get_acquisition_key(czi_info)
+    # benchmarks cached by earlier versions lack the decompression
+    if "inflate_throughput" not in estimates["compression"].get(acquisition_key, {}):
+        estimates["compression"][acquisition_key] = benchmark_compression(first_czi)
+    else:
+        IJ.log("Reusing the compression benchmark of a similar acquisition")
+    if estimator_cache and (benchmark_only or not dry_run):
+        write_json(estimator_cache, estimates)
 
-    export_path_fused_temp = (
-        fused_tiff_dir + "/" + project_filename.replace(".xml", "_fused.xml")
+    # chunk layout and compression decide the read speed of registration and fusion
+    hdf5_layout = choose_hdf5_layout(
+        czi_info, estimates["compression"][acquisition_key], disk_throughput, raw_size
     )
+    log_hdf5_layout(hdf5_layout)
+    if benchmark_only or not dry_run:
+        write_json(first_czi + "_hdf5_layout.json", hdf5_layout)
+
+    # regions of interest are fused instead of the complete dataset
+    rois = parse_roi_list(roi_list) if fuse else []
+
+    # outputs with their checksums and problems found while verifying them
+    manifest = {}
+    problems = []
+
+    # datasets fitting in memory are registered from the CZI and fused from memory,
+    # without the H5 resave
+    decoded_size = get_decoded_size(czi_info, raw_size)
+    in_memory = False
+
+    if fuse:
+        fusion_strategy = check_fusion_settings(
+            raw_size,
+            czi_info,
+            disk_throughput,
+            hdf5_layout["chunk_sizes"][0][2],
+            None if rois else decoded_size,
+        )
+        in_memory = fusion_strategy["name"] == "In-memory"
+        ram_handling = fusion_strategy["ram_handling"]
+        fuse_tiff = fusion_strategy["fuse_tiff"]
+        downsampling = fusion_strategy["downsampling"]
+        if not dry_run:
+            write_json(first_czi + "_fusion_strategy.json", fusion_strategy)
+
+    project_path_temp = temp + "/" + project_filename
+    export_path_temp = temp + "/" + project_filename_short
+    export_path_fused_temp = project_path_temp.replace(".xml", "_fused.xml")
+
+    # if no conversion is to ims is selected, save the fused tiff in a new folder next to the raw data instead
+    if not convert_to_ims:
+        fused_tiff_dir = parent_dir + "/" + filename + "_fused"
+
+        if not dry_run and not os.path.exists(fused_tiff_dir):
+            os.mkdir(fused_tiff_dir)
+
+        export_path_fused_temp = (
+            fused_tiff_dir + "/" + project_filename.replace(".xml", "_fused.xml")
+        )
 
-# IJ.log("retrieving calibration from " + str(filename) + ", this can take ~5 minutes..." )
-# first_czi_calibration = get_calibration_from_metadata(first_czi)
-# get_cal_time = round( (time.time() - execution_start_time) / 60.0 )
-# print("time to get calibration [min]" + str(get_cal_time))
+    if in_memory:
+        # registered in place, the CZI files are referenced relative to the defined XML
+        project_path_temp = project_path
 
-# run BigStitcher
-# define_dataset
+    # IJ.log("retrieving calibration from " + str(filename) + ", this can take ~5 minutes..." )
+    # first_czi_calibration = get_calibration_from_metadata(first_czi)
+    # get_cal_time = round( (time.time() - execution_start_time) / 60.0 )
+    # print("time to get calibration [min]" + str(get_cal_time))
 
-if reader == "LightSheet 7 (Zen tiling)":
-    IJ.run(
-        "Define dataset ...",
-        "define_dataset=[Zeiss Lightsheet 7 Dataset Loader (Bioformats)] "
-        + "project_filename=["
-        + project_filename
-        + "] "
-        + "first_czi=["
-        + first_czi
-        + "] "
-        + "apply_rotation_to_dataset "
-        + "fix_bioformats",
-    )
-elif reader == "LightSheet Z.1 / 7 (Tile scan macro)":
-    IJ.run(
-        "Define dataset ...",
-        "define_dataset=[Zeiss Lightsheet Z.1 Dataset Loader (Bioformats)] "
-        + "project_filename=["
-        + project_filename
-        + "] "
-        + "first_czi=["
-        + first_czi
-        + "] "
-        + "apply_rotation_to_dataset "
-        + "fix_bioformats",
-    )
+    # run BigStitcher
+    # define_dataset
 
-dataset_def_time = round((time.time() - execution_start_time) / 60.0)
-print("time to define dataset [min]" + str(dataset_def_time))
-
-xml_file = project_path
-
-dbf = DocumentBuilderFactory.newInstance()
-db = dbf.newDocumentBuilder()
-dom = db.parse(xml_file)
-experimentEL = dom.getDocumentElement()
-
-nodeList = dom.getElementsByTagName("Attributes")
-for i in range(nodeList.getLength()):
-    node = nodeList.item(i).getAttributes().getNamedItem("name").getNodeValue()
-    if node == "channel":
-        nbr_chnl = int(nodeList.item(i).getElementsByTagName("Channel").getLength())
-    if node == "illumination":
-        nbr_ill = int(nodeList.item(i).getElementsByTagName("Illumination").getLength())
-
-timepoints_node = dom.getElementsByTagName("Timepoints")
-nbr_tp = (
-    int(timepoints_node.item(0).getElementsByTagName("last").item(0).getTextContent())
-    + 1
-)
-
-IJ.log(
-    "Found "
-    + str(nbr_chnl)
-    + " channels, "
-    + str(nbr_ill)
-    + " illuminations and "
-    + str(nbr_tp)
-    + " timepoints"
-)
-
-shutil.copy2(project_path, project_path_temp)
-shutil.copy2(project_path, export_path_fused_temp)
-
-if not convert_to_ims:
-    shutil.copy2(project_path, export_path_fused_temp)
-
-# resave as h5/xml
-IJ.run(
-    "As HDF5 ...",
-    "select=["
-    + project_path
-    + "] "
-    + "resave_angle=[All angles] "
-    + "resave_channel=[All channels] "
-    + "resave_illumination=[All illuminations] "
-    + "resave_tile=[All tiles] "
-    + "resave_timepoint=[All Timepoints] "
-    + "export_path=["
-    + project_path_temp
-    + "]",
-)
-
-resave_time = round((time.time() - execution_start_time) / 60.0) - dataset_def_time
-print("time to resave dataset to h5/xml [min]" + str(resave_time))
-
-# calculate pairwise shifts
-IJ.run(
-    "Calculate pairwise shifts ...",
-    "select=["
-    + project_path_temp
-    + "] "
-    + "process_angle=[All angles] "
-    + "process_channel=[All channels] "
-    + "process_illumination=[All illuminations] "
-    + "process_tile=[All tiles] "
-    + "process_timepoint=[All Timepoints] "
-    + "method=[Phase Correlation] "
-    + "channels=[Average Channels] "
-    + "illuminations=[Average Illuminations]",
-)
-
-# filter shifts with 0.7 corr. threshold
-IJ.run(
-    "Filter pairwise shifts ...",
-    "select=["
-    + project_path_temp
-    + "] "
-    + "filter_by_link_quality "
-    + "min_r=0.7 "
-    + "max_r=1 "
-    + "max_shift_in_x=0 "
-    + "max_shift_in_y=0 "
-    + "max_shift_in_z=0 "
-    + "max_displacement=0",
-)
-
-# do global optimization
-IJ.run(
-    "Optimize globally and apply shifts ...",
-    "select=["
-    + project_path_temp
-    + "] "
-    + "process_angle=[All angles] "
-    + "process_channel=[All channels] "
-    + "process_illumination=[All illuminations] "
-    + "process_tile=[All tiles] "
-    + "process_timepoint=[All Timepoints] "
-    + "relative=2.500 "
-    + "absolute=3.500 "
-    + "global_optimization_strategy=[Two-Round using Metadata to align unconnected Tiles] "
-    + "fix_group_0-0,",
-)
-
-# select illuminations
-if autoselect_illuminations:
-    IJ.run(
-        "Select Illuminations",
-        "select=[" + project_path_temp + "] " + "selection=[Pick brightest]",
-    )
+    if reader == "LightSheet 7 (Zen tiling)":
+        run_stage(
+            "Define dataset ...",
+            "define_dataset=[Zeiss Lightsheet 7 Dataset Loader (Bioformats)] "
+            + "project_filename=["
+            + project_filename
+            + "] "
+            + "first_czi=["
+            + first_czi
+            + "] "
+            + "apply_rotation_to_dataset "
+            + "fix_bioformats",
+            # reading the metadata of all CZI files takes ~5 minutes
+            estimated_minutes=5,
+        )
+    elif reader == "LightSheet Z.1 / 7 (Tile scan macro)":
+        run_stage(
+            "Define dataset ...",
+            "define_dataset=[Zeiss Lightsheet Z.1 Dataset Loader (Bioformats)] "
+            + "project_filename=["
+            + project_filename
+            + "] "
+            + "first_czi=["
+            + first_czi
+            + "] "
+            + "apply_rotation_to_dataset "
+            + "fix_bioformats",
+            # reading the metadata of all CZI files takes ~5 minutes
+            estimated_minutes=5,
+        )
+
+    dataset_def_time = round((time.time() - execution_start_time) / 60.0)
+    print("time to define dataset [min]" + str(dataset_def_time))
+
+    if dry_run:
+        # the project XML doesn't exist yet, use the CZI metadata instead
+        nbr_chnl = czi_info["nbr_chnl"]
+        nbr_ill = "?"
+        nbr_tp = czi_info["nbr_tp"]
+    else:
+        xml_file = project_path
+
+        dbf = DocumentBuilderFactory.newInstance()
+        db = dbf.newDocumentBuilder()
+        dom = db.parse(xml_file)
+        experimentEL = dom.getDocumentElement()
+
+        nodeList = dom.getElementsByTagName("Attributes")
+        for i in range(nodeList.getLength()):
+            node = nodeList.item(i).getAttributes().getNamedItem("name").getNodeValue()
+            if node == "channel":
+                nbr_chnl = int(
+                    nodeList.item(i).getElementsByTagName("Channel").getLength()
+                )
+            if node == "illumination":
+                nbr_ill = int(
+                    nodeList.item(i).getElementsByTagName("Illumination").getLength()
+                )
+
+        timepoints_node = dom.getElementsByTagName("Timepoints")
+        nbr_tp = (
+            int(
+                timepoints_node.item(0)
+                .getElementsByTagName("last")
+                .item(0)
+                .getTextContent()
+            )
+            + 1
+        )
 
-registration_time = round((time.time() - execution_start_time) / 60.0) - resave_time
-print("time to register tiles [min]" + str(registration_time))
+    IJ.log(
+        "Found "
+        + str(nbr_chnl)
+        + " channels, "
+        + str(nbr_ill)
+        + " illuminations and "
+        + str(nbr_tp)
+        + " timepoints"
+    )
 
-# TODO: introduce option for auto bounding box function
+    # the fused XML is only written by the fusion into a H5/XML, the TIFF fusion has none
+    if not dry_run and not in_memory:
+        shutil.copy2(project_path, project_path_temp)
 
-if fuse:
+    resave_bytes = raw_size * (
+        hdf5_layout["compression_ratio"] if hdf5_layout["compress"] else 1
+    )
+    resave_minutes = min(hdf5_layout["raw_minutes"], hdf5_layout["compressed_minutes"])
+    registration_minutes = estimate_io_minutes(raw_size, 0, disk_throughput)
+
+    if in_memory:
+        # no resave, the shifts are calculated on downsampled views read from the CZI
+        IJ.log("Dataset fits in memory, skipping the resave to h5/xml")
+        run_stage(
+            "Calculate pairwise shifts ...",
+            get_pairwise_shifts_options(project_path_temp, [2, 2, 1]),
+            estimated_minutes=registration_minutes,
+        )
+        resave_time = 0
+
+    elif timepoints_in_flight and nbr_tp > 1:
+        # resave and calculate the shifts by timepoint, only the registration of the
+        # last timepoint isn't hidden behind the resave
+        tp_commands = []
+        for tp in range(nbr_tp):
+            tp_path = project_path_temp.replace(".xml", "_tp%s.xml" % tp)
+            tp_commands.append(
+                (
+                    "As HDF5 ...",
+                    get_timepoint_resave_options(
+                        project_path, tp, tp_path, hdf5_layout
+                    ),
+                )
+            )
+            tp_commands.append(
+                ("Calculate pairwise shifts ...", get_pairwise_shifts_options(tp_path))
+            )
+        run_stage(
+            "Resave and calculate pairwise shifts by timepoint",
+            "As HDF5 ... and Calculate pairwise shifts ... for timepoints 0-%s, "
+            % (nbr_tp - 1)
+            + "%s in flight, " % timepoints_in_flight
+            + "merged into "
+            + project_path_temp,
+            output_dir=temp,
+            expected_bytes=resave_bytes,
+            estimated_minutes=resave_minutes + registration_minutes / nbr_tp,
+            action=lambda: resave_and_register_by_timepoint(
+                project_path,
+                project_path_temp,
+                range(nbr_tp),
+                hdf5_layout,
+                timepoints_in_flight,
+            ),
+            commands=tp_commands,
+        )
+        resave_time = (
+            round((time.time() - execution_start_time) / 60.0) - dataset_def_time
+        )
+        print(
+            "time to resave and calculate shifts by timepoint [min]" + str(resave_time)
+        )
 
-    if fuse_tiff:
-        # re-save as tiff, as fusing *from* h5/xml is really slow
-        IJ.run(
-            "As TIFF ...",
+    else:
+        # resave as h5/xml
+        run_stage(
+            "As HDF5 ...",
             "select=["
-            + project_path_temp
+            + project_path
             + "] "
             + "resave_angle=[All angles] "
             + "resave_channel=[All channels] "
             + "resave_illumination=[All illuminations] "
             + "resave_tile=[All tiles] "
             + "resave_timepoint=[All Timepoints] "
+            + get_hdf5_layout_options(hdf5_layout)
             + "export_path=["
             + project_path_temp
             + "]",
+            output_dir=temp,
+            expected_bytes=resave_bytes,
+            estimated_minutes=resave_minutes,
         )
 
-        # fuse dataset to a new xml/tiff, since fusing *to* h5/xml is really slow
-        IJ.run(
-            "Fuse dataset ...",
-            "select=["
-            + project_path_temp
-            + "] "
-            + "process_angle=[All angles] "
-            + "process_channel=[All channels] "
-            + "process_illumination=[All illuminations] "
-            + "process_tile=[All tiles] "
-            + "process_timepoint=[All Timepoints] "
-            + "bounding_box=[Currently Selected Views] "
-            + "downsampling="
-            + str(downsampling)
-            + " "
-            + "pixel_type=[16-bit unsigned integer] "
-            + "interpolation=[Linear Interpolation] "
-            + "image="
-            + ram_handling
-            + " "
-            + "interest_points_for_non_rigid=[-= Disable Non-Rigid =-] "
-            + "blend "
-            + "preserve_original "
-            + "produce=[Each timepoint & channel] "
-            + "fused_image=[Save as new XML Project (TIFF)] "
-            + "export_path=["
-            + export_path_fused_temp
-            + "]",
+        resave_time = (
+            round((time.time() - execution_start_time) / 60.0) - dataset_def_time
         )
-    else:
-        IJ.log("Datasets too big, fusion will happen on the H5/XML")
-        IJ.run(
-            "Fuse dataset ...",
-            "select=["
-            + project_path_temp
-            + "] "
-            + "process_angle=[All angles] "
-            + "process_channel=[All channels] "
-            + "process_illumination=[All illuminations] "
-            + "process_tile=[All tiles] "
-            + "process_timepoint=[All Timepoints] "
-            + "bounding_box=[Currently Selected Views] "
-            + "downsampling="
-            + str(downsampling)
-            + " "
-            + "pixel_type=[16-bit unsigned integer] "
-            + "interpolation=[Linear Interpolation] "
-            + "image="
-            + ram_handling
-            + " "
-            + "interest_points_for_non_rigid=[-= Disable Non-Rigid =-] "
-            + "blend "
-            + "preserve_original "
-            + "produce=[Each timepoint & channel] "
-            + "fused_image=[Save as new XML Project (HDF5)] "
-            + "export_path=["
-            + export_path_fused_temp
-            + "]",
+        print("time to resave dataset to h5/xml [min]" + str(resave_time))
+
+        # calculate pairwise shifts
+        run_stage(
+            "Calculate pairwise shifts ...",
+            get_pairwise_shifts_options(project_path_temp),
+            estimated_minutes=registration_minutes,
         )
 
-    fusion_time = round((time.time() - execution_start_time) / 60.0) - registration_time
-    print("time to fuse dataset [min]" + str(fusion_time))
+    # filter shifts with 0.7 corr. threshold
+    run_stage(
+        "Filter pairwise shifts ...",
+        "select=["
+        + project_path_temp
+        + "] "
+        + "filter_by_link_quality "
+        + "min_r=0.7 "
+        + "max_r=1 "
+        + "max_shift_in_x=0 "
+        + "max_shift_in_y=0 "
+        + "max_shift_in_z=0 "
+        + "max_displacement=0",
+        # only works on the shifts stored in the XML
+        estimated_minutes=1,
+    )
+
+    # do global optimization
+    run_stage(
+        "Optimize globally and apply shifts ...",
+        "select=["
+        + project_path_temp
+        + "] "
+        + "process_angle=[All angles] "
+        + "process_channel=[All channels] "
+        + "process_illumination=[All illuminations] "
+        + "process_tile=[All tiles] "
+        + "process_timepoint=[All Timepoints] "
+        + "relative=2.500 "
+        + "absolute=3.500 "
+        + "global_optimization_strategy=[Two-Round using Metadata to align unconnected Tiles] "
+        + "fix_group_0-0,",
+        estimated_minutes=1,
+    )
+
+    # select illuminations
+    if autoselect_illuminations:
+        run_stage(
+            "Select Illuminations",
+            "select=[" + project_path_temp + "] " + "selection=[Pick brightest]",
+            estimated_minutes=estimate_io_minutes(raw_size, 0, disk_throughput),
+        )
+
+    registration_time = round((time.time() - execution_start_time) / 60.0) - resave_time
+    print("time to register tiles [min]" + str(registration_time))
+
+    # TODO: introduce option for auto bounding box function
+
+    if rois:
+        roi_dir = parent_dir + "/" + filename + "_rois"
+        if not dry_run and not os.path.exists(roi_dir):
+            os.mkdir(roi_dir)
+        IJ.log("Fusing %s regions of interest..." % len(rois))
+        roi_output = run_stage(
+            "Fuse regions of interest",
+            "; ".join(str(roi) for roi in rois),
+            output_dir=roi_dir,
+            action=lambda: fuse_rois(project_path_temp, rois, roi_dir, downsampling),
+        )
+        if not dry_run:
+            # temp holds the only registered project, keep it if a region is missing
+            manifest.update(roi_output["outputs"])
+            problems += roi_output["problems"]
+            for tiff_path, output in sorted(roi_output["outputs"].items()):
+                problems += verify_tiff(
+                    tiff_path,
+                    [output["width"], output["height"], output["planes"]],
+                    output["bytes_per_px"],
+                )
+
+        fusion_time = (
+            round((time.time() - execution_start_time) / 60.0) - registration_time
+        )
+        print("time to fuse regions of interest [min]" + str(fusion_time))
+
+    elif fuse:
+
+        if fuse_tiff:
+            # fuse straight from the h5, reading it slab by slab in the order its blocks
+            # are stored, instead of re-saving the whole dataset as TIFF first
+            # without h5, the views are decoded once from the CZI and kept in memory
+            slab_depth = hdf5_layout["chunk_sizes"][0][2]
+            view_cache_bytes = get_free_memory() / 2 if in_memory else 0
+            fused_output = run_stage(
+                (
+                    "Fuse dataset from memory"
+                    if in_memory
+                    else "Fuse dataset from H5 (block-cached)"
+                ),
+                "select=[%s] downsampling=%s slab_depth=%s view_cache=%s export_path=[%s]"
+                % (
+                    project_path_temp,
+                    downsampling,
+                    slab_depth,
+                    convert_bytes(view_cache_bytes),
+                    export_path_fused_temp,
+                ),
+                output_dir=os.path.dirname(export_path_fused_temp),
+                expected_bytes=fusion_strategy["fused_size"] / downsampling**3,
+                estimated_minutes=estimate_io_minutes(
+                    raw_size,
+                    fusion_strategy["fused_size"] / downsampling**3,
+                    disk_throughput,
+                ),
+                action=lambda: fuse_to_tiff(
+                    project_path_temp,
+                    os.path.dirname(export_path_fused_temp),
+                    downsampling,
+                    slab_depth,
+                    view_cache_bytes,
+                    export_type == "16-bit LZW compressed",
+                ),
+            )
+        else:
+            IJ.log("Datasets too big, fusion will happen on the H5/XML")
+            run_stage(
+                "Fuse dataset ...",
+                "select=["
+                + project_path_temp
+                + "] "
+                + "process_angle=[All angles] "
+                + "process_channel=[All channels] "
+                + "process_illumination=[All illuminations] "
+                + "process_tile=[All tiles] "
+                + "process_timepoint=[All Timepoints] "
+                + "bounding_box=[Currently Selected Views] "
+                + "downsampling="
+                + str(downsampling)
+                + " "
+                + "pixel_type=[16-bit unsigned integer] "
+                + "interpolation=[Linear Interpolation] "
+                + "image="
+                + ram_handling
+                + " "
+                + "interest_points_for_non_rigid=[-= Disable Non-Rigid =-] "
+                + "blend "
+                + "preserve_original "
+                + "produce=[Each timepoint & channel] "
+                + "fused_image=[Save as new XML Project (HDF5)] "
+                + "export_path=["
+                + export_path_fused_temp
+                + "]",
+                output_dir=os.path.dirname(export_path_fused_temp),
+                expected_bytes=fusion_strategy["fused_size"] / downsampling**3,
+                # random access into the h5 is roughly 10 times slower
+                estimated_minutes=estimate_io_minutes(
+                    10 * raw_size,
+                    fusion_strategy["fused_size"] / downsampling**3,
+                    disk_throughput,
+                ),
+            )
+
+        fusion_time = (
+            round((time.time() - execution_start_time) / 60.0) - registration_time
+        )
+        print("time to fuse dataset [min]" + str(fusion_time))
+
+    imaris_path = locate_latest_imaris()
+
+    if dry_run:
+        plan_summary = {
+            "Views processed": "%s series x %s channels x %s timepoints"
+            % (czi_info["nbr_series"], nbr_chnl, nbr_tp),
+            "Raw data size": convert_bytes(raw_size),
+            "Disk throughput": convert_bytes(disk_throughput) + "/s",
+            "Free memory in IJ": convert_bytes(get_free_memory()),
+            "HDF5 layout": hdf5_layout,
+            "Convert to Imaris5": bool(
+                fuse and convert_to_ims and imaris_path and not rois
+            ),
+        }
+        if fuse and not rois:
+            plan_summary["Fusion strategy"] = "%s (%s, downsampling %s)" % (
+                fusion_strategy["name"],
+                ram_handling,
+                downsampling,
+            )
+        print_plan(plan, plan_summary, first_czi + "_plan.json")
+
+    if fuse and not rois and not dry_run:
+        # the intensity range of the fused TIFFs and their checksums were computed while
+        # they were written, the fused h5 is only checked for complete datasets and its
+        # intensity range is sampled from the raw data
+        IJ.log("Analysing intensity range and verifying fused output...")
+        if fuse_tiff:
+            fused_dims = fused_output["dimensions"]
+            fused_tiffs = get_fused_tiffs(os.path.dirname(export_path_fused_temp))
+            histograms = fused_output["histograms"]
+            manifest.update(fused_output["outputs"])
+            if not fused_tiffs:
+                problems.append("no fused TIFF found for " + export_path_fused_temp)
+        else:
+            fused_dims = get_fused_dimensions(export_path_fused_temp)
+            histograms = get_sampled_input_histograms(first_czi, nbr_chnl)
+            fused_h5 = export_path_fused_temp.replace(".xml", ".h5")
+            problems += verify_hdf5_datasets(
+                fused_h5,
+                [
+                    "/t%05d/s%02d/0/cells" % (tp, setup)
+                    for tp in range(nbr_tp)
+                    for setup in range(nbr_chnl)
+                ],
+                fused_dims,
+            )
+            if os.path.exists(fused_h5):
+                manifest[fused_h5] = {"bytes": os.path.getsize(fused_h5)}
+
+        intensity_stats = {
+            "source": "fused output" if fuse_tiff else "sampled raw data",
+            "channels": dict(
+                (str(chnl), get_percentiles(histogram))
+                for chnl, histogram in histograms.items()
+            ),
+        }
+        for chnl, stats in sorted(intensity_stats["channels"].items()):
+            IJ.log(
+                "Channel %s: min %s, max %s, 0.1-99.9 percentiles %s-%s (of 65535)"
+                % (chnl, stats["min"], stats["max"], stats["0.1"], stats["99.9"])
+            )
+        write_json(first_czi + "_intensity_stats.json", intensity_stats)
+
+        # the LZW compression is already applied by the fusion, only the rescale to
+        # 8-bit needs the percentiles of the whole fused volume
+        if export_type != "16-bit":
+            if fuse_tiff and export_type == "8-bit rescaled":
+                IJ.log("Exporting fused image as " + export_type + "...")
+                for tiff_path, _, chnl in fused_tiffs:
+                    stats = intensity_stats["channels"][str(chnl)]
+                    manifest[tiff_path] = export_fused_tiff(
+                        tiff_path,
+                        (stats["0.1"], stats["99.9"]),
+                        fused_output["voxel_size"],
+                    )
+            elif not fuse_tiff:
+                IJ.log("Fused image is saved as H5/XML, export type is ignored")
+
+        # the TIFFs on disk are checked once they are final
+        for tiff_path, output in sorted(manifest.items()):
+            if tiff_path.endswith(".tif"):
+                problems += verify_tiff(
+                    tiff_path,
+                    fused_dims,
+                    output["bytes_per_px"],
+                    compressed=export_type != "16-bit",
+                )
+
+    # free memory in IJ
+    if not dry_run:
+        IJ.log("collecting garbage...")
+        IJ.run("Collect Garbage", "")
+        # the batch goes on with the next dataset, waiting for the heap to shrink would
+        # only delay it by three minutes per dataset
+        if not batch_mode:
+            time.sleep(60.0)
+            IJ.run("Collect Garbage", "")
+            time.sleep(60.0)
+            IJ.run("Collect Garbage", "")
+            time.sleep(60.0)
+
+    # TODO: offer conversion to IMS or h5/xml or nothing, i.e leave as tiff
+    # convert to Imaris5 format
+    if fuse and convert_to_ims and imaris_path and not rois and not dry_run:
+        if fuse_tiff:
+            file_to_convert_to_ims = temp + "/fused_tp_0_ch_0.tif"
+        else:
+            print("i am here")
+            file_to_convert_to_ims = export_path_fused_temp
+        # imaris_voxelsize = "%s-%s-%s" % (first_czi_calibration[0], first_czi_calibration[1], first_czi_calibration[2])
+
+        os.chdir(locate_latest_imaris())
+        command = (
+            'ImarisConvert.exe -i "%s" -of Imaris5 -o "%s" -fsdc _CH_ -fsdt _TP_'
+            % (
+                file_to_convert_to_ims,
+                first_czi.replace(".czi", ".ims"),
+            )
+        )
+        print("\n%s" % command)
+        IJ.log("Converting to Imaris5 .ims...")
+        return_code = subprocess.call(command, shell=True)
+        IJ.log("Conversion to .ims is finished")
+        if return_code:
+            problems.append("ImarisConvert failed with exit code %s" % return_code)
+
+        IJ.log("Verifying .ims file...")
+        ims_path = first_czi.replace(".czi", ".ims")
+        if fuse_tiff:
+            ims_timepoints = sorted(set(tp for _, tp, _ in fused_tiffs))
+            ims_channels = sorted(set(chnl for _, _, chnl in fused_tiffs))
+        else:
+            ims_timepoints = range(nbr_tp)
+            ims_channels = range(nbr_chnl)
+        if os.path.exists(ims_path):
+            problems += verify_hdf5_datasets(
+                ims_path,
+                [
+                    "/DataSet/ResolutionLevel 0/TimePoint %d/Channel %d/Data"
+                    % (tp, chnl)
+                    for tp in ims_timepoints
+                    for chnl in ims_channels
+                ],
+                fused_dims,
+                allow_padding=True,
+            )
+            manifest[ims_path] = {"bytes": os.path.getsize(ims_path)}
+        else:
+            problems.append(ims_path + " was not written")
 
-# free memory in IJ
-IJ.log("collecting garbage...")
-IJ.run("Collect Garbage", "")
-time.sleep(60.0)
-IJ.run("Collect Garbage", "")
-time.sleep(60.0)
-IJ.run("Collect Garbage", "")
-time.sleep(60.0)
+        convert_to_ims_time = (
+            round((time.time() - execution_start_time) / 60.0) - fusion_time
+        )
+        print("time to convert dataset to ims [min]" + str(convert_to_ims_time))
+
+    if not imaris_path:
+        print("Can't find Imaris path, conversion will be skipped")
+        # the fused TIFFs in temp are the only fused output, they must not be deleted
+        if fuse and convert_to_ims and not rois and not dry_run:
+            problems.append("ImarisConvert wasn't found, the .ims was not written")
+
+    if fuse and not dry_run:
+        for problem in problems:
+            IJ.log("Verification failed: " + problem)
+        write_json(
+            first_czi + "_manifest.json",
+            {"outputs": manifest, "verified": not problems, "problems": problems},
+        )
 
-imaris_path = locate_latest_imaris()
+    # remove temp folder, but only if the outputs are complete
+    if delete_temp_files and fuse and not dry_run:
+        if problems:
+            IJ.log("Keeping intermediate files in " + temp + " as verification failed")
+        else:
+            shutil.rmtree(temp, ignore_errors=True)
 
-# TODO: offer conversion to IMS or h5/xml or nothing, i.e leave as tiff
-# convert to Imaris5 format
-if fuse and convert_to_ims and imaris_path:
-    if fuse_tiff:
-        file_to_convert_to_ims = temp + "/fused_tp_0_ch_0.tif"
+    total_execution_time_min = round((time.time() - execution_start_time) / 60.0)
+
+    if dry_run:
+        print("Dry run, no email was sent")
+    elif email_address:
+        send_mail("imcf@unibas.ch", email_address, filename, total_execution_time_min)
     else:
-        print("i am here")
-        file_to_convert_to_ims = export_path_fused_temp
-    # imaris_voxelsize = "%s-%s-%s" % (first_czi_calibration[0], first_czi_calibration[1], first_czi_calibration[2])
-
-    os.chdir(locate_latest_imaris())
-    command = 'ImarisConvert.exe -i "%s" -of Imaris5 -o "%s" -fsdc _CH_ -fsdt _TP_' % (
-        file_to_convert_to_ims,
-        first_czi.replace(".czi", ".ims"),
-    )
-    print("\n%s" % command)
-    IJ.log("Converting to Imaris5 .ims...")
-    subprocess.call(command, shell=True)
-    IJ.log("Conversion to .ims is finished")
+        print("Email address field is empty, no email was sent")
 
-    convert_to_ims_time = (
-        round((time.time() - execution_start_time) / 60.0) - fusion_time
+    IJ.log("\n~~~ Job summary ~~~")
+    IJ.log("Filename: " + str(filename))
+    # IJ.log("First czi original voxel size xyz: " + str(first_czi_calibration) )
+    IJ.log(
+        "Automatically select best illumination side: " + str(autoselect_illuminations)
     )
-    print("time to convert dataset to ims [min]" + str(convert_to_ims_time))
-
-if not imaris_path:
-    print("Can't find Imaris path, conversion will be skipped")
-
-# remove temp folder
-if delete_temp_files and fuse:
-    shutil.rmtree(temp, ignore_errors=True)
-
-total_execution_time_min = round((time.time() - execution_start_time) / 60.0)
-
-if email_address:
-    send_mail("imcf@unibas.ch", email_address, filename, total_execution_time_min)
-else:
-    print("Email address field is empty, no email was sent")
-
-IJ.log("\n~~~ Job summary ~~~")
-IJ.log("Filename: " + str(filename))
-# IJ.log("First czi original voxel size xyz: " + str(first_czi_calibration) )
-IJ.log("Automatically select best illumination side: " + str(autoselect_illuminations))
-IJ.log("Fuse image: " + str(fuse))
-if fuse == True:
-    IJ.log("Fusion mode: " + str(ram_handling))
-IJ.log("Convert fused image to Imaris5: " + str(convert_to_ims))
-IJ.log("Delete intermediate files: " + str(delete_temp_files))
-IJ.log("Send info email to: " + str(email_address))
-IJ.log("Total time in minutes: " + str(total_execution_time_min))
-IJ.log("All done")
-IJ.selectWindow("Log")
-IJ.saveAs("Text", str(first_czi) + "_BigStitcher_Log")
+    IJ.log("Fuse image: " + str(fuse))
+    if fuse == True:
+        IJ.log("Fusion strategy: " + str(fusion_strategy["name"]))
+        IJ.log("Fusion mode: " + str(ram_handling))
+        IJ.log("Fusion downsampling: " + str(downsampling))
+    IJ.log("Regions of interest: " + str(len(rois) or "whole dataset"))
+    IJ.log("Fused image export: " + str(export_type))
+    IJ.log("Convert fused image to Imaris5: " + str(convert_to_ims))
+    IJ.log("Delete intermediate files: " + str(delete_temp_files))
+    if fuse == True and not dry_run:
+        IJ.log("Outputs verified: " + str(not problems))
+    IJ.log("Send info email to: " + str(email_address))
+    IJ.log("Total time in minutes: " + str(total_execution_time_min))
+    IJ.log("All done")
+    # a dry run only writes its plan
+    if not dry_run:
+        IJ.selectWindow("Log")
+        IJ.saveAs("Text", str(first_czi) + "_BigStitcher_Log")
+finally:
+    if not dry_run:
+        monitor.stop()
@@ -0,0 +1,328 @@
+# ─── SCRIPT PARAMETERS ──────────────────────────────────────────────────────────
+
+#@ File (label="Select registered project XML", description="the xml of a dataset registered with the BigStitcher or Multiview Reconstruction script") project_xml
+#@ Integer (label="Port", description="the server only listens on localhost", value=8080) port
+#@ Integer (label="Block size", description="edge length of the served blocks in pixels", value=128) block_size
+#@ Integer (label="Block cache (% of free memory)", style="slider", min=5, max=80, stepSize=5, value=50) cache_percentage
+
+# ─── IMPORTS ────────────────────────────────────────────────────────────────────
+
+# python imports
+import json
+import re
+import threading
+import BaseHTTPServer
+import SocketServer
+from collections import OrderedDict
+
+# Imagej imports
+from ij import IJ
+
+# java imports
+from java.nio import ByteBuffer, ByteOrder
+
+# imglib2 imports
+from net.imglib2.converter import Converters, RealUnsignedShortConverter
+from net.imglib2.img.array import ArrayImgs
+from net.imglib2.type.numeric.integer import UnsignedShortType
+from net.imglib2.util import ImgUtil
+from net.imglib2.view import Views
+
+# multiview reconstruction imports
+from net.preibisch.mvrecon.fiji.spimdata import XmlIoSpimData2
+from net.preibisch.mvrecon.process.boundingbox import BoundingBoxMaximal
+from net.preibisch.mvrecon.process.fusion import FusionTools
+
+# requirements:
+# BigStitcher, Multiview Reconstruction >= 10.2
+
+# ─── FUNCTIONS ──────────────────────────────────────────────────────────────────
+
+
+def get_free_memory():
+    """gets the free memory thats available to ImageJ
+
+    Returns
+    -------
+    free_memory : integer
+        the free memory in bytes
+    """
+    max_memory = int(IJ.maxMemory())
+    used_memory = int(IJ.currentMemory())
+    free_memory = max_memory - used_memory
+
+    return free_memory
+
+
+def convert_bytes(size):
+    """Convert size from bytes to a readable value
+
+    Parameters
+    ----------
+    size : int
+        Byte size
+
+    Returns
+    -------
+    str
+        Easy to read value with the correct unit
+    """
+    for x in ["bytes", "KB", "MB", "GB", "TB"]:
+        if size < 1024.0:
+            return "%3.1f %s" % (size, x)
+        size /= 1024.0
+
+    return size
+
+
+def group_views(spim_data):
+    """Group the present views of a dataset by timepoint and channel
+
+    Parameters
+    ----------
+    spim_data : SpimData2
+        The registered dataset
+
+    Returns
+    -------
+    dict
+        List of ViewIds for each (timepoint, channel) tuple
+    """
+    groups = {}
+    for view in spim_data.getSequenceDescription().getViewDescriptions().values():
+        if not view.isPresent():
+            continue
+        key = (view.getTimePointId(), view.getViewSetup().getChannel().getId())
+        groups.setdefault(key, []).append(view)
+
+    return groups
+
+
+def get_pyramid_factors(dimensions, block_size):
+    """Get downsampling factors until the volume fits into a single block
+
+    Parameters
+    ----------
+    dimensions : list of int
+        Size of the full resolution volume in x, y and z
+    block_size : int
+        Edge length of a block
+
+    Returns
+    -------
+    list of int
+        Downsampling factor of each pyramid level, starting with 1
+    """
+    factors = [1]
+    while max(dimensions) / factors[-1] > block_size:
+        factors.append(factors[-1] * 2)
+
+    return factors
+
+
+class BlockCache(object):
+    """LRU cache of fused blocks, limited by the number of bytes it holds"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            block = self.blocks.pop(key, None)
+            if block is not None:
+                # re-insert to mark it as most recently used
+                self.blocks[key] = block
+
+            return block
+
+    def put(self, key, block):
+        with self.lock:
+            if key in self.blocks:
+                return
+            self.blocks[key] = block
+            self.size += len(block[1])
+            while self.size > self.max_bytes and len(self.blocks) > 1:
+                _, evicted = self.blocks.popitem(last=False)
+                self.size -= len(evicted[1])
+
+
+class FusedRegionServer(object):
+    """Fuse blocks of a registered dataset on request
+
+    Nothing is fused ahead of time: the virtual fusion of each timepoint, channel and
+    pyramid level is only set up when a block of it is first requested, and only the
+    requested block is computed.
+    """
+
+    def __init__(self, xml_path, block_size, cache):
+        self.spim_data = XmlIoSpimData2("").load(xml_path)
+        self.views = group_views(self.spim_data)
+        self.block_size = block_size
+        self.cache = cache
+        self.fusions = {}
+        self.lock = threading.Lock()
+
+        all_views = [view for views in self.views.values() for view in views]
+        self.bounding_box = BoundingBoxMaximal(all_views, self.spim_data).estimate(
+            "Full Bounding Box"
+        )
+        self.dimensions = [int(self.bounding_box.dimension(d)) for d in range(3)]
+        self.factors = get_pyramid_factors(self.dimensions, block_size)
+
+    def get_info(self):
+        return {
+            "timepoints": sorted(set(tp for tp, _ in self.views)),
+            "channels": sorted(set(chnl for _, chnl in self.views)),
+            "block_size": self.block_size,
+            "pixel_type": "uint16",
+            "byte_order": "little endian",
+            "axis_order": "xyz",
+            "levels": [
+                {
+                    "downsampling": factor,
+                    "dimensions": [-(-size // factor) for size in self.dimensions],
+                }
+                for factor in self.factors
+            ],
+        }
+
+    def get_fusion(self, level, tp, chnl):
+        key = (level, tp, chnl)
+        with self.lock:
+            if key not in self.fusions:
+                fused = FusionTools.fuseVirtual(
+                    self.spim_data,
+                    self.views[(tp, chnl)],
+                    True,  # blending
+                    False,  # content based fusion
+                    1,  # linear interpolation
+                    self.bounding_box,
+                    float(self.factors[level]),
+                    None,  # no intensity adjustments
+                )
+                # depending on the version a (image, transform) pair is returned
+                if hasattr(fused, "getA"):
+                    fused = fused.getA()
+                self.fusions[key] = Views.zeroMin(fused)
+
+            return self.fusions[key]
+
+    def get_block(self, level, tp, chnl, block_index):
+        """Get a fused block as little endian uint16 bytes
+
+        Parameters
+        ----------
+        level : int
+            Pyramid level
+        tp : int
+            Timepoint id
+        chnl : int
+            Channel id
+        block_index : list of int
+            Index of the block in x, y and z
+
+        Returns
+        -------
+        tuple
+            Dimensions of the block (might be smaller at the border) and its bytes
+        """
+        key = (level, tp, chnl) + tuple(block_index)
+        block = self.cache.get(key)
+        if block is not None:
+            return block
+
+        fused = self.get_fusion(level, tp, chnl)
+        block_min = [i * self.block_size for i in block_index]
+        block_max = [
+            min(start + self.block_size, fused.dimension(d)) - 1
+            for d, start in enumerate(block_min)
+        ]
+        if any(start > end for start, end in zip(block_min, block_max)):
+            raise IndexError("block %s is outside of the volume" % block_index)
+
+        region = Converters.convert(
+            Views.interval(fused, block_min, block_max),
+            RealUnsignedShortConverter(0, 65535),
+            UnsignedShortType(),
+        )
+        dims = [end - start + 1 for start, end in zip(block_min, block_max)]
+        target = ArrayImgs.unsignedShorts(dims)
+        ImgUtil.copy(region, target)
+
+        pixels = target.update(None).getCurrentStorageArray()
+        buffer = ByteBuffer.allocate(len(pixels) * 2)
+        buffer.order(ByteOrder.LITTLE_ENDIAN).asShortBuffer().put(pixels)
+        block = (dims, buffer.array().tostring())
+        self.cache.put(key, block)
+
+        return block
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server handling every request in its own thread"""
+
+    daemon_threads = True
+
+
+class RegionRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve /info, /block/<level>/<tp>/<channel>/<x>/<y>/<z> and /shutdown"""
+
+    block_path = re.compile(r"^/block/(\d+)/(\d+)/(\d+)/(\d+)/(\d+)/(\d+)$")
+
+    def send_body(self, body, content_type, headers=None):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        match = self.block_path.match(self.path)
+        if self.path == "/info":
+            self.send_body(json.dumps(region_server.get_info()), "application/json")
+        elif self.path == "/shutdown":
+            self.send_body("shutting down", "text/plain")
+            threading.Thread(target=http_server.shutdown).start()
+        elif match:
+            level, tp, chnl, x, y, z = [int(x) for x in match.groups()]
+            try:
+                dims, body = region_server.get_block(level, tp, chnl, [x, y, z])
+            except (IndexError, KeyError) as error:
+                self.send_error(404, str(error))
+                return
+            self.send_body(
+                body,
+                "application/octet-stream",
+                {"X-Block-Dimensions": ",".join(str(d) for d in dims)},
+            )
+        else:
+            self.send_error(404, "unknown path " + self.path)
+
+    def log_message(self, format, *args):
+        # keep the ImageJ log readable, requests are only printed to the console
+        print(format % args)
+
+
+# ─── MAIN CODE ──────────────────────────────────────────────────────────────────
+
+cache_bytes = get_free_memory() * cache_percentage / 100
+IJ.log("Loading " + str(project_xml) + "...")
+region_server = FusedRegionServer(str(project_xml), block_size, BlockCache(cache_bytes))
+
+http_server = ThreadedHTTPServer(("localhost", port), RegionRequestHandler)
+IJ.log("Fused volume: " + " x ".join(str(x) for x in region_server.dimensions))
+IJ.log("Pyramid levels (downsampling): " + str(region_server.factors))
+IJ.log("Block cache: " + convert_bytes(cache_bytes))
+IJ.log("Serving fused blocks on http://localhost:%s" % port)
+IJ.log("  /info for the dataset layout")
+IJ.log("  /block/<level>/<timepoint>/<channel>/<x>/<y>/<z> for a block")
+IJ.log("  /shutdown to stop the server")
+
+http_server.serve_forever()
+http_server.server_close()
+IJ.log("Server stopped")
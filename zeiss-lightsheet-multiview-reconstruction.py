@@ -3,11 +3,13 @@
 #@ File (label="Select first CZI file", description="select only the first czi file")  input_path
 #@ String (label="What reader to use ?", choices={"LightSheet 7 (Zen tiling)","LightSheet Z.1 / 7 (Tile scan macro)"}, style="listBox") reader
 #@ Boolean (label="Automatically select best illumination side", description="discard the other illumination", value=false) autoselect_illuminations
-#@ Boolean (label="Fuse image", description="saves a separate fused h5/xml", value=true) fuse
+#@ Boolean (label="Fuse image", description="saves a separate fused h5/xml, or tiffs for the conversion to Imaris5", value=true) fuse
 #@ File (label="Select a temp directory", style="directory", description="choose a local drive with enough space, e.g. S: on VAMP or D: on a desktop workstation") temp_directory
 #@ Integer (label="Downsample fused image", description="1 = full resolution", style="slider", min=1, max=20, stepSize=1, value=1) downsampling
 #@ Boolean (label="Convert fused image to Imaris5", description="convert to fused image to *.ims", value=true) convert_to_ims
 #@ String (label="Send info email to: ", description="empty = skip") email_address
+#@ Boolean (label="Dry run", description="only print the execution plan with cost estimates and save it as *_plan.json, nothing is processed", value=false) dry_run
+#@ Boolean (label="Only benchmark the HDF5 layout", description="measure the disk throughput and compression, then choose pyramid, block sizes and compression for the resave and print them, implies a dry run", value=false) benchmark_only
 
 # TODO: include tp range request by default, maybe in two variables, t_start and t_end. Then use them instead of "[All Timepoints]"
 
@@ -19,10 +21,49 @@ import glob
 import time
 import smtplib
 import shutil
+import subprocess
+import json
+import re
+import threading
+from collections import deque
 
 # Imagej imports
 from ij import IJ
 
+# java imports
+import jarray
+from java.io import FileOutputStream
+from java.nio import ByteBuffer, ByteOrder
+from java.lang import Runtime, System
+from java.lang.management import ManagementFactory
+from java.security import MessageDigest
+from java.util.concurrent import Callable, Executors
+from java.util.zip import Deflater, Inflater
+from javax.xml.parsers import DocumentBuilderFactory
+
+# hdf5 imports to verify the written files
+from ch.systemsx.cisd.hdf5 import HDF5Factory
+
+# imglib2 imports
+from net.imglib2.converter import Converters, RealUnsignedShortConverter
+from net.imglib2.img.planar import PlanarImgs
+from net.imglib2.type.numeric.integer import UnsignedShortType
+from net.imglib2.util import ImgUtil
+from net.imglib2.view import Views
+
+# multiview reconstruction imports to fuse from the h5
+from net.preibisch.mvrecon.fiji.spimdata import XmlIoSpimData2
+from net.preibisch.mvrecon.process.boundingbox import BoundingBoxMaximal
+from net.preibisch.mvrecon.process.fusion import FusionTools
+
+# ome imports to parse metadata
+from loci.formats import FormatTools
+from loci.formats import MetadataTools
+from loci.formats.in import ZeissCZIReader, DynamicMetadataOptions
+from loci.formats.out import OMETiffWriter
+from ome.units import UNITS
+from ome.units.quantity import Length
+
 # requirements:
 # BigStitcher, Multiview Reconstruction >= 10.2
 # faim-imagej-imaris-tools-0.0.1.jar (https://maven.scijava.org/service/local/repositories/releases/content/org/scijava/faim-imagej-imaris-tools/0.0.1/faim-imagej-imaris-tools-0.0.1.jar)
@@ -112,221 +153,1324 @@ def locate_latest_imaris(paths_to_check=None):
 
     return imaris_paths[-1]
 
+
+def convert_bytes(size):
+    """Convert size from bytes to a readable value
+
+    Parameters
+    ----------
+    size : int
+        Byte size
+
+    Returns
+    -------
+    str
+        Easy to read value with the correct unit
+    """
+    for x in ["bytes", "KB", "MB", "GB", "TB"]:
+        if size < 1024.0:
+            return "%3.1f %s" % (size, x)
+        size /= 1024.0
+
+    return size
+
+
+def write_json(path, content):
+    """Write a dictionary to a json file
+
+    Parameters
+    ----------
+    path : str
+        Path of the json file
+    content : dict
+        Content to be written
+    """
+    with open(path, "w") as json_file:
+        json.dump(content, json_file, indent=4, sort_keys=True)
+
+
+def get_hex_digest(digest):
+    """Get the hexadecimal representation of a MessageDigest
+
+    Parameters
+    ----------
+    digest : java.security.MessageDigest
+        Digest that all data has been fed into
+
+    Returns
+    -------
+    str
+        The checksum as hex string
+    """
+    return "".join("%02x" % (byte & 0xFF) for byte in digest.digest())
+
+
+def get_fused_dimensions(xml_path):
+    """Get the size of the fused volumes from the fused XML project
+
+    Parameters
+    ----------
+    xml_path : str
+        Path to the XML project written by the fusion
+
+    Returns
+    -------
+    list of int
+        Size of the fused volumes in x, y and z
+    """
+    dom = DocumentBuilderFactory.newInstance().newDocumentBuilder().parse(xml_path)
+    view_setup = dom.getElementsByTagName("ViewSetup").item(0)
+    size = view_setup.getElementsByTagName("size").item(0).getTextContent()
+
+    return [int(x) for x in size.split()]
+
+
+def verify_hdf5_datasets(h5_path, dataset_paths, expected_dims, allow_padding=False):
+    """Check that an HDF5 file can be opened and contains complete datasets
+
+    Parameters
+    ----------
+    h5_path : str
+        Path to the HDF5 (or Imaris5) file
+    dataset_paths : list of str
+        Datasets that need to be present
+    expected_dims : list of int
+        Expected size in x, y and z
+    allow_padding : bool, optional
+        Whether datasets may be larger than expected, as Imaris pads them to full
+        chunks, by default False
+
+    Returns
+    -------
+    list of str
+        Problems found, empty if the file is complete
+    """
+    problems = []
+    try:
+        reader = HDF5Factory.openForReading(h5_path)
+    except Exception as error:
+        return ["%s can't be opened: %s" % (h5_path, error)]
+
+    try:
+        # HDF5 stores the dimensions as z, y, x
+        expected = list(reversed(expected_dims))
+        for dataset_path in dataset_paths:
+            if not reader.object().exists(dataset_path):
+                problems.append("%s is missing in %s" % (dataset_path, h5_path))
+                continue
+            dims = list(
+                reader.object().getDataSetInformation(dataset_path).getDimensions()
+            )
+            if allow_padding:
+                complete = all(d >= e for d, e in zip(dims, expected))
+            else:
+                complete = dims == expected
+            if not complete:
+                problems.append("%s in %s has shape %s" % (dataset_path, h5_path, dims))
+    finally:
+        reader.close()
+
+    return problems
+
+
+def get_czi_files(first_czi):
+    """List the CZI files of an acquisition
+
+    Zen splits large acquisitions into "<name>.czi", "<name>(1).czi",
+    "<name>(2).czi" and so on. Other acquisitions in the same folder, like
+    "<name>0.czi" next to "<name>.czi", are not included.
+
+    Parameters
+    ----------
+    first_czi : str
+        Path to the first CZI file
+
+    Returns
+    -------
+    list of str
+        Paths of all CZI files of the acquisition
+    """
+    folder = os.path.dirname(first_czi)
+    name = os.path.basename(first_czi)[: -len(".czi")]
+    pattern = re.compile(re.escape(name) + r"(\(\d+\))?\.czi$")
+
+    return [
+        folder + "/" + x for x in sorted(os.listdir(folder)) if pattern.match(x)
+    ]
+
+
+def get_czi_info(czi_path):
+    """Read the dimensions of a dataset from the metadata of its first CZI file
+
+    Parameters
+    ----------
+    czi_path : str
+        Path to the first CZI file
+
+    Returns
+    -------
+    dict
+        Number of timepoints ("nbr_tp"), channels ("nbr_chnl") and series
+        ("nbr_series", i.e. tiles, angles and illuminations), the size of a single
+        view ("size_x", "size_y", "size_z"), its bytes per pixel ("bytes_per_px")
+        and the physical voxel size ("voxel_size", None if not available)
+    """
+    reader = ZeissCZIReader()
+    m = DynamicMetadataOptions()
+    m.setBoolean(ZeissCZIReader.ALLOW_AUTOSTITCHING_KEY, False)
+    m.setBoolean(ZeissCZIReader.RELATIVE_POSITIONS_KEY, True)
+    reader.setMetadataOptions(m)
+    omeMeta = MetadataTools.createOMEXMLMetadata()
+    reader.setMetadataStore(omeMeta)
+    reader.setId(str(czi_path))
+
+    try:
+        voxel_size = [
+            omeMeta.getPixelsPhysicalSizeX(0).value(),
+            omeMeta.getPixelsPhysicalSizeY(0).value(),
+            omeMeta.getPixelsPhysicalSizeZ(0).value(),
+        ]
+    except AttributeError:
+        # one of the physical sizes is missing in the metadata
+        voxel_size = None
+
+    czi_info = {
+        "nbr_tp": omeMeta.getTimestampAnnotationCount() + 1,
+        "nbr_chnl": omeMeta.getChannelCount(0),
+        "nbr_series": reader.getSeriesCount(),
+        "size_x": reader.getSizeX(),
+        "size_y": reader.getSizeY(),
+        "size_z": reader.getSizeZ(),
+        "bytes_per_px": FormatTools.getBytesPerPixel(reader.getPixelType()),
+        "voxel_size": voxel_size,
+    }
+    reader.close()
+
+    return czi_info
+
+
+def measure_disk_throughput(directory, test_size=256 * 1024 * 1024):
+    """Measure the sequential write throughput of the disk holding a directory
+
+    Parameters
+    ----------
+    directory : str
+        Path to the directory that will receive the intermediate files
+    test_size : int, optional
+        Number of bytes to write for the measurement, by default 256 MB
+
+    Returns
+    -------
+    float
+        Write throughput in bytes per second
+    """
+    test_file = os.path.join(directory, "disk_throughput_test.tmp")
+    block = jarray.zeros(4 * 1024 * 1024, "b")
+
+    start = time.time()
+    stream = FileOutputStream(test_file)
+    try:
+        for _ in range(test_size // len(block)):
+            stream.write(block)
+        # make sure the data actually hits the disk and not only the OS cache
+        stream.getFD().sync()
+    finally:
+        stream.close()
+    duration = max(time.time() - start, 0.001)
+    os.remove(test_file)
+
+    return test_size / duration
+
+
+def benchmark_compression(czi_path, nbr_planes=16):
+    """Measure how well and how fast raw planes compress and decompress with deflate
+
+    The planes are sampled evenly from the first tile of the first CZI file and
+    compressed with the same deflate level HDF5 uses by default, then decompressed
+    again.
+
+    Parameters
+    ----------
+    czi_path : str
+        Path to the first CZI file
+    nbr_planes : int, optional
+        Number of planes to compress, by default 16
+
+    Returns
+    -------
+    dict
+        Compressed size relative to the raw size ("ratio"), the single thread
+        deflate throughput ("throughput") and inflate throughput
+        ("inflate_throughput") in bytes per second of raw data
+    """
+    reader = ZeissCZIReader()
+    m = DynamicMetadataOptions()
+    m.setBoolean(ZeissCZIReader.ALLOW_AUTOSTITCHING_KEY, False)
+    reader.setMetadataOptions(m)
+    reader.setId(str(czi_path))
+    step = max(1, reader.getSizeZ() // nbr_planes)
+    planes = [
+        reader.openBytes(reader.getIndex(z, 0, 0))
+        for z in range(0, reader.getSizeZ(), step)[:nbr_planes]
+    ]
+    reader.close()
+
+    raw_bytes = compressed_bytes = 0
+    compressed = []
+    start = time.time()
+    for plane in planes:
+        # incompressible data grows by a few bytes per block at most
+        buffer = jarray.zeros(len(plane) + 1024, "b")
+        size = 0
+        deflater = Deflater(6)
+        deflater.setInput(plane)
+        deflater.finish()
+        while not deflater.finished():
+            size += deflater.deflate(buffer, size, len(buffer) - size)
+        deflater.end()
+        compressed.append((buffer, size))
+        raw_bytes += len(plane)
+        compressed_bytes += size
+    duration = max(time.time() - start, 0.001)
+
+    output = jarray.zeros(len(planes[0]), "b")
+    start = time.time()
+    for buffer, size in compressed:
+        inflater = Inflater()
+        inflater.setInput(buffer, 0, size)
+        while not inflater.finished():
+            inflater.inflate(output)
+        inflater.end()
+    inflate_duration = max(time.time() - start, 0.001)
+
+    return {
+        "ratio": float(compressed_bytes) / raw_bytes,
+        "throughput": raw_bytes / duration,
+        "inflate_throughput": raw_bytes / inflate_duration,
+    }
+
+
+def choose_hdf5_layout(czi_info, compression, disk_throughput, raw_size):
+    """Choose pyramid levels, block sizes and compression for the HDF5 resave
+
+    Every level halves x and y, z is only halved once the xy pixel size caught up
+    with the z spacing. Blocks are chosen to cover a roughly isotropic physical
+    volume of 16k pixels, which is what the phase correlation and the fusion read.
+    Compression is used when writing and reading the smaller file is faster than
+    writing and reading the raw data, given the measured disk, deflate and inflate
+    throughput. The HDF5 library runs its filters in the thread that writes or
+    reads, so compression and decompression are modelled as single threaded and
+    add up with the disk I/O.
+
+    Parameters
+    ----------
+    czi_info : dict
+        Dimensions of the dataset, see `get_czi_info`
+    compression : dict
+        Deflate benchmark, see `benchmark_compression`
+    disk_throughput : float
+        Write throughput of the target volume in bytes per second
+    raw_size : int
+        Size of the raw data in bytes
+
+    Returns
+    -------
+    dict
+        The "subsampling_factors" and "chunk_sizes" of each level, whether to
+        "compress" and the predicted resave duration with and without compression
+    """
+    voxel_size = czi_info["voxel_size"] or [1, 1, 1]
+    size = [czi_info["size_x"], czi_info["size_y"], czi_info["size_z"]]
+
+    factors = [[1, 1, 1]]
+    while min(size[0], size[1]) / (factors[-1][0] * 2) >= 64:
+        xy, z = factors[-1][0] * 2, factors[-1][2]
+        if voxel_size[0] * xy > voxel_size[2] * z * 1.5:
+            z *= 2
+        factors.append([xy, xy, z])
+
+    chunk_sizes = []
+    for xy, _, z in factors:
+        anisotropy = (voxel_size[2] * z) / (voxel_size[0] * xy)
+        if anisotropy >= 2:
+            chunk_z = max(4, int(16 / anisotropy))
+            chunk_xy = min(64, int((16384 / chunk_z) ** 0.5))
+            chunk_sizes.append([chunk_xy, chunk_xy, chunk_z])
+        else:
+            chunk_sizes.append([16, 16, 16])
+
+    # written once by the resave and read once by registration and fusion
+    raw_minutes = 2 * raw_size / (disk_throughput * 60.0)
+    compressed_minutes = (
+        raw_size / (compression["throughput"] * 60.0)
+        + raw_size / (compression["inflate_throughput"] * 60.0)
+        + 2 * raw_size * compression["ratio"] / (disk_throughput * 60.0)
+    )
+
+    return {
+        "subsampling_factors": factors,
+        "chunk_sizes": chunk_sizes,
+        "compress": compressed_minutes < raw_minutes,
+        "compression_ratio": compression["ratio"],
+        "raw_minutes": raw_minutes,
+        "compressed_minutes": compressed_minutes,
+    }
+
+
+def get_hdf5_layout_options(layout):
+    """Get the options of the "As HDF5" command for a given layout
+
+    Parameters
+    ----------
+    layout : dict
+        The layout, see `choose_hdf5_layout`
+
+    Returns
+    -------
+    str
+        The mipmap, chunking and compression options
+    """
+
+    def format_levels(levels):
+        return "[{ " + ", ".join("{%d,%d,%d}" % tuple(x) for x in levels) + " }]"
+
+    options = (
+        "manual_mipmap_setup "
+        + "subsampling_factors="
+        + format_levels(layout["subsampling_factors"])
+        + " "
+        + "hdf5_chunk_sizes="
+        + format_levels(layout["chunk_sizes"])
+        + " "
+        + "timepoints_per_partition=1 "
+        + "setups_per_partition=0 "
+    )
+    if layout["compress"]:
+        options += "use_deflate_compression "
+
+    return options
+
+
+def log_hdf5_layout(layout):
+    """Print the chosen HDF5 layout to the log
+
+    Parameters
+    ----------
+    layout : dict
+        The layout, see `choose_hdf5_layout`
+    """
+    IJ.log("HDF5 subsampling factors: " + str(layout["subsampling_factors"]))
+    IJ.log("HDF5 block sizes: " + str(layout["chunk_sizes"]))
+    IJ.log(
+        "HDF5 deflate compression: %s (ratio %.2f, predicted %.1f min vs %.1f min raw)"
+        % (
+            layout["compress"],
+            layout["compression_ratio"],
+            layout["compressed_minutes"],
+            layout["raw_minutes"],
+        )
+    )
+
+
+def get_directory_size(path):
+    """Get the total size of all files in a directory tree
+
+    Parameters
+    ----------
+    path : str
+        Path to the directory
+
+    Returns
+    -------
+    int
+        Size in bytes, 0 if the directory doesn't exist
+    """
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # files can disappear while a plugin is writing
+                pass
+
+    return size
+
+
+def get_process_io():
+    """Get the bytes read and written by this process so far
+
+    Only available on Linux, where the counters are read from /proc/self/io.
+
+    Returns
+    -------
+    tuple of int or None
+        Bytes read and written, None if not available
+    """
+    try:
+        with open("/proc/self/io") as io_file:
+            counters = dict(line.split(": ") for line in io_file.read().splitlines())
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (IOError, KeyError, ValueError):
+        return None
+
+
+def get_windows_process_io_rates():
+    """Get the current read and write rates of this process on Windows
+
+    The rates are read from the process performance counters, which are available
+    without admin rights and, unlike the disk counters, include the traffic to
+    network shares.
+
+    Returns
+    -------
+    tuple of float or None
+        Bytes read and written per second, None if not available
+    """
+    if not System.getProperty("os.name").startswith("Windows"):
+        return None
+
+    pid = ManagementFactory.getRuntimeMXBean().getName().split("@")[0]
+    command = (
+        "Get-CimInstance Win32_PerfFormattedData_PerfProc_Process "
+        "-Filter 'IDProcess=%s' | ForEach-Object { [string]$_.IOReadBytesPersec + "
+        "' ' + $_.IOWriteBytesPersec }" % pid
+    )
+    try:
+        output = subprocess.check_output(
+            ["powershell", "-NoProfile", "-Command", command]
+        )
+        read_rate, write_rate = output.split()
+        return float(read_rate), float(write_rate)
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return None
+
+
+class StageMonitor(threading.Thread):
+    """Background thread sampling JVM and I/O statistics during long IJ.run stages
+
+    Every few seconds while a stage is active, the heap usage, GC time, thread count,
+    process CPU load and the read/write throughput are appended to a tab separated
+    time series file. A status line with the current stage, the write throughput and
+    the projected completion is shown in the ImageJ status bar.
+    The throughput is taken from the I/O counters of this process, on Linux from
+    /proc and on Windows from its performance counters; if neither is available,
+    the write throughput falls back to the growth of the output folder.
+    """
+
+    columns = [
+        "time",
+        "stage",
+        "heap_used_mb",
+        "heap_max_mb",
+        "gc_ms",
+        "threads",
+        "cpu_load",
+        "read_mb_s",
+        "write_mb_s",
+        "output_mb",
+        "eta_min",
+    ]
+
+    def __init__(self, log_path, interval=5.0):
+        threading.Thread.__init__(self, name="StageMonitor")
+        self.daemon = True
+        self.log_path = log_path
+        self.interval = interval
+        self.stage = None
+        self.output_dir = None
+        self.expected_bytes = None
+        self.stopped = threading.Event()
+
+        with open(self.log_path, "w") as log_file:
+            log_file.write("\t".join(self.columns) + "\n")
+
+    def start_stage(self, stage, output_dir=None, expected_bytes=None):
+        self.output_dir = output_dir
+        self.expected_bytes = expected_bytes
+        self.stage_start_size = get_directory_size(output_dir) if output_dir else 0
+        self.stage_start_time = time.time()
+        self.stage = stage
+
+    def end_stage(self):
+        self.stage = None
+        IJ.showStatus("")
+
+    def stop(self):
+        self.stopped.set()
+
+    def get_gc_time(self):
+        return sum(
+            bean.getCollectionTime()
+            for bean in ManagementFactory.getGarbageCollectorMXBeans()
+        )
+
+    def get_cpu_load(self):
+        try:
+            return ManagementFactory.getOperatingSystemMXBean().getProcessCpuLoad()
+        except Exception:
+            # only available on HotSpot based JVMs
+            return -1
+
+    def run(self):
+        last_time = time.time()
+        last_gc = self.get_gc_time()
+        last_io = get_process_io()
+        last_size = None
+
+        while not self.stopped.wait(self.interval):
+            now = time.time()
+            elapsed = max(now - last_time, 0.001)
+            gc_time = self.get_gc_time()
+            io = get_process_io()
+            stage = self.stage
+
+            if stage is None:
+                last_time, last_gc, last_io, last_size = now, gc_time, io, None
+                continue
+
+            read_rate = write_rate = -1
+            if io and last_io:
+                read_rate = (io[0] - last_io[0]) / elapsed / 1024**2
+                write_rate = (io[1] - last_io[1]) / elapsed / 1024**2
+            elif io is None:
+                # only queried while a stage is active, it starts a process
+                rates = get_windows_process_io_rates()
+                if rates:
+                    read_rate, write_rate = [x / 1024**2 for x in rates]
+
+            output_mb = eta_min = -1
+            if self.output_dir:
+                size = get_directory_size(self.output_dir)
+                output_mb = (size - self.stage_start_size) / 1024.0**2
+                if last_size is not None and write_rate < 0:
+                    write_rate = (size - last_size) / elapsed / 1024**2
+                last_size = size
+                if self.expected_bytes and output_mb > 0:
+                    stage_rate = output_mb / (now - self.stage_start_time)
+                    remaining = self.expected_bytes / 1024.0**2 - output_mb
+                    eta_min = max(remaining, 0) / stage_rate / 60.0
+
+            runtime = Runtime.getRuntime()
+            sample = [
+                time.strftime("%Y-%m-%d %H:%M:%S"),
+                stage,
+                (runtime.totalMemory() - runtime.freeMemory()) / 1024**2,
+                runtime.maxMemory() / 1024**2,
+                gc_time - last_gc,
+                ManagementFactory.getThreadMXBean().getThreadCount(),
+                "%.2f" % self.get_cpu_load(),
+                "%.1f" % read_rate,
+                "%.1f" % write_rate,
+                "%.0f" % output_mb,
+                "%.1f" % eta_min,
+            ]
+            with open(self.log_path, "a") as log_file:
+                log_file.write("\t".join(str(x) for x in sample) + "\n")
+
+            status = "%s: %.1f MB/s written" % (stage, write_rate)
+            if eta_min >= 0:
+                status += ", ~%.0f min remaining" % eta_min
+            IJ.showStatus(status)
+
+            last_time, last_gc, last_io = now, gc_time, io
+
+
+def estimate_io_minutes(read_bytes, write_bytes, disk_throughput):
+    """Estimate the duration of a stage that is limited by disk I/O
+
+    Parameters
+    ----------
+    read_bytes : float
+        Number of bytes read by the stage
+    write_bytes : float
+        Number of bytes written by the stage
+    disk_throughput : float
+        Disk throughput in bytes per second
+
+    Returns
+    -------
+    float
+        Estimated duration in minutes
+    """
+    return (read_bytes + write_bytes) / (disk_throughput * 60.0)
+
+
+def run_stage(
+    command,
+    options,
+    output_dir=None,
+    expected_bytes=None,
+    estimated_minutes=None,
+    action=None,
+    commands=None,
+):
+    """Run an IJ command while the stage monitor records its statistics
+
+    Every stage is added to the execution plan. In a dry run the command is only
+    added to the plan, but not executed. Stages implemented in this script pass
+    their function as `action`, which is run instead of the IJ command, and list
+    the IJ commands it runs as `commands`.
+
+    Parameters
+    ----------
+    command : str
+        The IJ command
+    options : str
+        The options of the command
+    output_dir : str, optional
+        Folder the command writes its output to, used for the throughput and
+        the projected completion, by default None
+    expected_bytes : float, optional
+        Expected size of the output, by default None
+    estimated_minutes : float, optional
+        Estimated duration of the stage, by default None
+    action : callable, optional
+        Function to run instead of `IJ.run`, by default None
+    commands : list of tuple, optional
+        (command, options) of every IJ command run by `action`, by default None
+
+    Returns
+    -------
+    object
+        What `action` returned, None for IJ commands and in a dry run
+    """
+    stage = {
+        "command": command,
+        "options": options,
+        "scripted": action is not None,
+        "commands": commands or [],
+        "output_dir": output_dir,
+        "expected_bytes": expected_bytes,
+        "estimated_minutes": estimated_minutes,
+    }
+    plan.append(stage)
+    if dry_run:
+        return
+
+    start = time.time()
+    monitor.start_stage(command.replace(" ...", ""), output_dir, expected_bytes)
+    try:
+        if action:
+            return action()
+        IJ.run(command, options)
+    finally:
+        monitor.end_stage()
+        stage["minutes"] = (time.time() - start) / 60.0
+
+
+def group_views(spim_data):
+    """Group the present views of a dataset by timepoint and channel
+
+    Parameters
+    ----------
+    spim_data : SpimData2
+        The registered dataset
+
+    Returns
+    -------
+    dict
+        List of ViewIds for each (timepoint, channel) tuple
+    """
+    groups = {}
+    for view in spim_data.getSequenceDescription().getViewDescriptions().values():
+        if not view.isPresent():
+            continue
+        key = (view.getTimePointId(), view.getViewSetup().getChannel().getId())
+        groups.setdefault(key, []).append(view)
+
+    return groups
+
+
+def get_slab_depth(plane_bytes, max_depth, memory):
+    """Get the number of fused planes that can be computed and kept at once
+
+    Parameters
+    ----------
+    plane_bytes : float
+        Size of a single fused 16-bit plane in bytes
+    max_depth : int
+        Number of planes wanted per slab, e.g. the z block size of the H5
+    memory : float
+        Memory available for a slab in bytes
+
+    Returns
+    -------
+    int
+        Number of planes per slab, 0 if a single plane doesn't fit or is larger than
+        the 2 GB a Java array can hold
+    """
+    if plane_bytes > 2**31 - 1:
+        return 0
+
+    return int(min(max_depth, memory // plane_bytes))
+
+
+class SlabTask(Callable):
+    """Compute a slab of consecutive z-planes of a (virtual) fused volume
+
+    The slab is stored plane by plane, so only a single plane has to fit into a
+    Java array.
+    """
+
+    def __init__(self, fused, z_start, z_end):
+        self.fused = fused
+        self.z_start = z_start
+        self.z_end = z_end
+
+    def call(self):
+        width, height = self.fused.dimension(0), self.fused.dimension(1)
+        slab = PlanarImgs.unsignedShorts([width, height, self.z_end - self.z_start])
+        ImgUtil.copy(
+            Views.interval(
+                self.fused,
+                [0, 0, self.z_start],
+                [width - 1, height - 1, self.z_end - 1],
+            ),
+            slab,
+        )
+
+        return [
+            slab.getPlane(z).getCurrentStorageArray()
+            for z in range(self.z_end - self.z_start)
+        ]
+
+
+def fuse_from_h5(xml_path, output_dir, downsampling, slab_depth):
+    """Fuse each timepoint and channel straight from the H5 into 16-bit TIFFs
+
+    The fused volume is computed in slabs of z-planes, following the z-order the
+    H5 blocks are stored in. While one slab is written, the next ones are already
+    fused by a thread pool; the number of slabs in flight is limited by the free
+    memory. Planes are resampled to the original z-spacing, like the
+    "preserve_original" option of "Fuse dataset ...". The checksum of each file is
+    computed while it is written.
+
+    Parameters
+    ----------
+    xml_path : str
+        Path to the registered project XML
+    output_dir : str
+        Folder to write the fused_tp_<t>_ch_<c>.tif files to
+    downsampling : int
+        Downsampling of the fused volumes
+    slab_depth : int
+        Number of z-planes fused at once, ideally the z block size of the H5
+
+    Returns
+    -------
+    dict
+        The written "files", the "dimensions" of the fused volumes in x, y, z and
+        the checksum and shape of every file as "outputs"
+    """
+    spim_data = XmlIoSpimData2("").load(xml_path)
+    groups = group_views(spim_data)
+    all_views = [view for views in groups.values() for view in views]
+    bounding_box = BoundingBoxMaximal(all_views, spim_data).estimate(
+        "Full Bounding Box"
+    )
+    voxel_size = all_views[0].getViewSetup().getVoxelSize()
+    unit = min(voxel_size.dimension(d) for d in range(3))
+    z_step = max(1, int(round(voxel_size.dimension(2) / unit / downsampling)))
+
+    threads = Runtime.getRuntime().availableProcessors()
+    executor = Executors.newFixedThreadPool(threads)
+    files = []
+    outputs = {}
+    try:
+        for (tp, chnl), views in sorted(groups.items()):
+            fused = FusionTools.fuseVirtual(
+                spim_data,
+                views,
+                True,  # blending
+                False,  # content based fusion
+                1,  # linear interpolation
+                bounding_box,
+                float(downsampling),
+                None,  # no intensity adjustments
+            )
+            # depending on the version a (image, transform) pair is returned
+            if hasattr(fused, "getA"):
+                fused = fused.getA()
+            fused = Views.subsample(Views.zeroMin(fused), [1, 1, z_step])
+            fused = Converters.convert(
+                fused, RealUnsignedShortConverter(0, 65535), UnsignedShortType()
+            )
+            width, height, depth = [int(fused.dimension(d)) for d in range(3)]
+
+            # slabs are limited to half of the free memory, thinner slabs than the H5
+            # blocks read them several times but keep huge planes feasible
+            plane_bytes = width * height * 2
+            memory = get_free_memory() / 2
+            planes_per_slab = get_slab_depth(plane_bytes, slab_depth, memory)
+            if not planes_per_slab:
+                raise MemoryError(
+                    "a fused plane of %s x %s pixels doesn't fit into %s, "
+                    "increase the memory or the downsampling"
+                    % (width, height, convert_bytes(memory))
+                )
+            # fused slabs waiting to be written
+            slab_bytes = plane_bytes * planes_per_slab
+            window = max(1, min(threads, int(memory / slab_bytes)))
+
+            omeMeta = MetadataTools.createOMEXMLMetadata()
+            MetadataTools.populateMetadata(
+                omeMeta, 0, None, True, "XYZCT", "uint16", width, height, depth, 1, 1, 1
+            )
+            pixel_size = unit * downsampling
+            omeMeta.setPixelsPhysicalSizeX(Length(pixel_size, UNITS.MICROMETER), 0)
+            omeMeta.setPixelsPhysicalSizeY(Length(pixel_size, UNITS.MICROMETER), 0)
+            omeMeta.setPixelsPhysicalSizeZ(
+                Length(pixel_size * z_step, UNITS.MICROMETER), 0
+            )
+
+            tiff_path = "%s/fused_tp_%s_ch_%s.tif" % (output_dir, tp, chnl)
+            IJ.log(
+                "Fusing %s with %s slabs of %s planes in flight..."
+                % (tiff_path, window, planes_per_slab)
+            )
+            writer = OMETiffWriter()
+            writer.setMetadataRetrieve(omeMeta)
+            writer.setBigTiff(True)
+            writer.setId(tiff_path)
+            digest = MessageDigest.getInstance("SHA-256")
+
+            z_starts = range(0, depth, planes_per_slab)
+            pending = deque()
+            try:
+                for z_start in z_starts[:window]:
+                    pending.append(
+                        executor.submit(
+                            SlabTask(
+                                fused, z_start, min(z_start + planes_per_slab, depth)
+                            )
+                        )
+                    )
+                next_slab = window
+                for z_start in z_starts:
+                    planes = pending.popleft().get()
+                    if next_slab < len(z_starts):
+                        z_next = z_starts[next_slab]
+                        pending.append(
+                            executor.submit(
+                                SlabTask(
+                                    fused, z_next, min(z_next + planes_per_slab, depth)
+                                )
+                            )
+                        )
+                        next_slab += 1
+                    for plane, pixels in enumerate(planes):
+                        buffer = ByteBuffer.allocate(plane_bytes)
+                        buffer.order(ByteOrder.LITTLE_ENDIAN).asShortBuffer().put(
+                            pixels
+                        )
+                        digest.update(buffer.array())
+                        writer.saveBytes(z_start + plane, buffer.array())
+            finally:
+                writer.close()
+            files.append(tiff_path)
+            outputs[tiff_path] = {
+                "checksum": get_hex_digest(digest),
+                "checksum_of": "pixel data",
+                "width": width,
+                "height": height,
+                "planes": depth,
+            }
+    finally:
+        executor.shutdown()
+
+    return {"files": files, "dimensions": [width, height, depth], "outputs": outputs}
+
+
+def print_plan(plan, summary, plan_path):
+    """Print the execution plan to the log and save it as json
+
+    Parameters
+    ----------
+    plan : list of dict
+        The stages, as recorded by `run_stage`
+    summary : dict
+        Additional information on the job, e.g. the views processed and the fusion
+        mode
+    plan_path : str
+        Path of the json file
+    """
+    IJ.log("\n~~~ Execution plan ~~~")
+    for key in sorted(summary):
+        IJ.log("%s: %s" % (key, summary[key]))
+
+    total_minutes = 0
+    for number, stage in enumerate(plan):
+        IJ.log("\nStage %d: %s" % (number + 1, stage["command"]))
+        if stage["scripted"]:
+            IJ.log("Run by this script: %s" % stage["options"])
+            for command, options in stage["commands"]:
+                IJ.log('IJ.run("%s", "%s")' % (command, options))
+        else:
+            IJ.log('IJ.run("%s", "%s")' % (stage["command"], stage["options"]))
+        if stage["output_dir"]:
+            expected = stage["expected_bytes"]
+            IJ.log(
+                "Writes to %s (%s)"
+                % (stage["output_dir"], convert_bytes(expected) if expected else "?")
+            )
+        if stage["estimated_minutes"] is not None:
+            IJ.log("Estimated time: %.1f min" % stage["estimated_minutes"])
+            total_minutes += stage["estimated_minutes"]
+
+    IJ.log("\nEstimated total time: %.1f min" % total_minutes)
+    write_json(plan_path, {"summary": summary, "stages": plan})
+
 # ─── MAIN CODE ──────────────────────────────────────────────────────────────────
 
 # get start time
 execution_start_time = time.time()
+dry_run = dry_run or benchmark_only
 
 first_czi = str(input_path).replace("\\", "/")
-project_path = first_czi.replace(".czi",".xml")
 fused_path = first_czi.replace(".czi","_fused.xml")
+project_path = first_czi.replace(".czi",".xml")
 filename = os.path.basename(first_czi)
 project_filename = filename.replace(".czi",".xml")
 parent_dir = os.path.dirname(first_czi)
+temp = str(temp_directory).replace("\\", "/") + "/temp"
 
-# define dataset
-if reader == "LightSheet 7 (Zen tiling)":
-    IJ.run(
-        "Define Multi-View Dataset",
-        "define_dataset=[Zeiss Lightsheet 7 Dataset Loader (Bioformats)] " +
-        "project_filename=[" + project_filename + "] " +
-        "first_czi=[" + first_czi + "] " +
-        "apply_rotation_to_dataset " +
-        "fix_bioformats"
-    )
+# stages run (or only planned in a dry run) with their cost estimates
+plan = []
 
-elif reader == "LightSheet Z.1 / 7 (Tile scan macro)":
-    IJ.run(
-        "Define Multi-View Dataset",
-        "define_dataset=[Zeiss Lightsheet Z.1 Dataset Loader (Bioformats)] " +
-        "project_filename=[" + project_filename + "] " +
-        "first_czi=[" + first_czi + "] " +
-        "apply_rotation_to_dataset " +
-        "fix_bioformats"
-    )
+# outputs with their checksums and problems found while verifying them
+manifest = {}
+problems = []
 
-# resave as h5/xml
-IJ.run(
-    "As HDF5",
-    "select=[" + project_path + "] " +
-    "resave_angle=[All angles] " +
-    "resave_channel=[All channels] " +
-    "resave_illumination=[All illuminations] " +
-    "resave_tile=[All tiles] " +
-    "resave_timepoint=[All Timepoints] " +
-    "use_deflate_compression " +
-    "export_path=[" + project_path + "]"
-)
-
-# detect interest point with advanced settings
-# TODO: maybe limit to only one channel, then forward the detections to all other channels
-# TODO: add option [Interactive ...], the skip the automatic values...if interactive mode is possible during a script.
-# TODO: make sigma and threshold user variables, but set the defaults to 1.8 and 0.008
-# TODO: test GPU integration
-IJ.run(
-    "Detect Interest Points for Registration",
-    "select=[" + project_path + "] " +
-    "process_angle=[All angles] " +
-    "process_channel=[All channels] " +
-    "process_illumination=[All illuminations] " +
-    "process_tile=[All tiles] " +
-    "process_timepoint=[All Timepoints] " +
-    "type_of_interest_point_detection=Difference-of-Gaussian " +
-    "label_interest_points=beads " +
-    "limit_amount_of_detections " +
-    "group_tiles group_illuminations " +
-    "subpixel_localization=[3-dimensional quadratic fit] " +
-    "interest_point_specification=[Advanced ...] " +
-    "downsample_xy=[Match Z Resolution (less downsampling)] " +
-    "downsample_z=1x " +
-    "sigma=1.80000 " +
-    "threshold=0.00800 " +
-    "find_maxima " +
-    "maximum_number=3000 " +
-    "type_of_detections_to_use=Brightest " +
-    "compute_on=[CPU (Java)]"
-)
-
-# register using interest points
-IJ.run(
-    "Register Dataset based on Interest Points",
-    "select=[" + project_path + "] " +
-    "process_angle=[All angles] " +
-    "process_channel=[All channels] " +
-    "process_illumination=[All illuminations] " +
-    "process_tile=[All tiles] " +
-    "process_timepoint=[All Timepoints] " +
-    "registration_algorithm=[Precise descriptor-based (translation invariant)] " +
-    "registration_in_between_views=[Compare all views against each other] " +
-    "interest_points=beads " +
-    "group_tiles " +
-    "group_illuminations " +
-    "group_channels " +
-    "fix_views=[Fix first view] " +
-    "map_back_views=[Do not map back (use this if views are fixed)] " +
-    "transformation=Affine " +
-    "regularize_model " +
-    "model_to_regularize_with=Rigid " +
-    "lamba=0.10 " +
-    "number_of_neighbors=3 " +
-    "redundancy=3 " +
-    "significance=2 " +
-    "allowed_error_for_ransac=5 " +
-    "ransac_iterations=Normal " +
-    "interestpoint_grouping=[Group interest points (simply combine all in one virtual view)] " +
-    "interest=5"
-)
-
-# select illuminations
-if autoselect_illuminations:
-    IJ.run(
-        "Select Illuminations",
-        "select=[" + project_path + "] " +
-        "selection=[Pick brightest]"
-    )
+# sample JVM and I/O statistics while the long stages are running
+if not dry_run:
+    monitor = StageMonitor(first_czi.replace(".czi", "") + "_monitor.tsv")
+    monitor.start()
+
+# stop the monitor thread also when a stage fails
+try:
+    czi_info = get_czi_info(first_czi)
+    raw_size = sum(os.path.getsize(czi) for czi in get_czi_files(first_czi))
+    if dry_run and not benchmark_only:
+        # a dry run only writes its plan, the write benchmark is left to benchmark_only
+        disk_throughput = h5_disk_throughput = 100 * 1024**2
+        IJ.log("Disk throughput not measured in a dry run, assuming 100 MB/s")
+    else:
+        disk_throughput = measure_disk_throughput(str(temp_directory))
+        h5_disk_throughput = measure_disk_throughput(parent_dir)
 
-# TODO: introduce option for auto bounding box function
+    # chunk layout and compression decide the read speed of registration and fusion,
+    # the h5 is written next to the raw data
+    hdf5_layout = choose_hdf5_layout(
+        czi_info, benchmark_compression(first_czi), h5_disk_throughput, raw_size
+    )
+    log_hdf5_layout(hdf5_layout)
+    if benchmark_only or not dry_run:
+        write_json(first_czi.replace(".czi", "") + "_hdf5_layout.json", hdf5_layout)
 
-# fuse and save as hdf5
-if fuse:
-    # check the file size of the file to be fused and compare to the available RAM
-    stitched_filesize = os.path.getsize( project_path.replace(".xml",".h5") )
-    free_memory = get_free_memory()
+    # define dataset
+    if reader == "LightSheet 7 (Zen tiling)":
+        run_stage(
+            "Define Multi-View Dataset",
+            "define_dataset=[Zeiss Lightsheet 7 Dataset Loader (Bioformats)] " +
+            "project_filename=[" + project_filename + "] " +
+            "first_czi=[" + first_czi + "] " +
+            "apply_rotation_to_dataset " +
+            "fix_bioformats",
+            # reading the metadata of all CZI files takes ~5 minutes
+            estimated_minutes=5
+        )
 
-    print("stitched_filesize " + str(stitched_filesize))
-    print("free memory in ij " + str(free_memory))
+    elif reader == "LightSheet Z.1 / 7 (Tile scan macro)":
+        run_stage(
+            "Define Multi-View Dataset",
+            "define_dataset=[Zeiss Lightsheet Z.1 Dataset Loader (Bioformats)] " +
+            "project_filename=[" + project_filename + "] " +
+            "first_czi=[" + first_czi + "] " +
+            "apply_rotation_to_dataset " +
+            "fix_bioformats",
+            # reading the metadata of all CZI files takes ~5 minutes
+            estimated_minutes=5
+        )
 
-    # TODO: include in below calculation downsampling * t_end, since only one t is fused at a time.
-    if free_memory > (1.94 * stitched_filesize / downsampling):
-        ram_handling = "[Precompute Image]"
-    else:
-        ram_handling = "Cached"
-    print("fusion mode used " + str(ram_handling))
-
-    # fuse dataset, save as new hdf5
-    # re-save as xml/tiff first in a temp location and fuse the xml/tiff instead, since fusing from an h5/xml is really slow
-    temp = str(temp_directory).replace("\\", "/") + "/temp"
-    if not os.path.exists(temp):
-        os.mkdir(temp)
-    shutil.copy2(project_path, temp)
-    temp_path = temp + "/" + project_filename
-    IJ.run(
-        "As TIFF ...",
+    # resave as h5/xml
+    run_stage(
+        "As HDF5",
         "select=[" + project_path + "] " +
         "resave_angle=[All angles] " +
         "resave_channel=[All channels] " +
         "resave_illumination=[All illuminations] " +
         "resave_tile=[All tiles] " +
         "resave_timepoint=[All Timepoints] " +
-        "export_path=[" + temp_path + "]"
+        get_hdf5_layout_options(hdf5_layout) +
+        "export_path=[" + project_path + "]",
+        output_dir=parent_dir,
+        expected_bytes=raw_size * (hdf5_layout["compression_ratio"] if hdf5_layout["compress"] else 1),
+        estimated_minutes=min(hdf5_layout["raw_minutes"], hdf5_layout["compressed_minutes"])
     )
 
-    IJ.run(
-        "Fuse dataset ...",
-        "select=[" + temp_path + "] " +
+    # detect interest point with advanced settings
+    # TODO: maybe limit to only one channel, then forward the detections to all other channels
+    # TODO: add option [Interactive ...], the skip the automatic values...if interactive mode is possible during a script.
+    # TODO: make sigma and threshold user variables, but set the defaults to 1.8 and 0.008
+    # TODO: test GPU integration
+    run_stage(
+        "Detect Interest Points for Registration",
+        "select=[" + project_path + "] " +
+        "process_angle=[All angles] " +
+        "process_channel=[All channels] " +
+        "process_illumination=[All illuminations] " +
+        "process_tile=[All tiles] " +
+        "process_timepoint=[All Timepoints] " +
+        "type_of_interest_point_detection=Difference-of-Gaussian " +
+        "label_interest_points=beads " +
+        "limit_amount_of_detections " +
+        "group_tiles group_illuminations " +
+        "subpixel_localization=[3-dimensional quadratic fit] " +
+        "interest_point_specification=[Advanced ...] " +
+        "downsample_xy=[Match Z Resolution (less downsampling)] " +
+        "downsample_z=1x " +
+        "sigma=1.80000 " +
+        "threshold=0.00800 " +
+        "find_maxima " +
+        "maximum_number=3000 " +
+        "type_of_detections_to_use=Brightest " +
+        "compute_on=[CPU (Java)]",
+        estimated_minutes=estimate_io_minutes(raw_size, 0, disk_throughput)
+    )
+
+    # register using interest points
+    run_stage(
+        "Register Dataset based on Interest Points",
+        "select=[" + project_path + "] " +
         "process_angle=[All angles] " +
         "process_channel=[All channels] " +
         "process_illumination=[All illuminations] " +
         "process_tile=[All tiles] " +
         "process_timepoint=[All Timepoints] " +
-        "bounding_box=[Currently Selected Views] " +
-        "downsampling=" + str(downsampling) + " " +
-        "pixel_type=[16-bit unsigned integer] " +
-        "interpolation=[Linear Interpolation] " +
-        "image=" + ram_handling + " " +
-        "interest_points_for_non_rigid=[-= Disable Non-Rigid =-] " +
-        "blend produce=[Each timepoint & channel] " +
-        "fused_image=[Save as new XML Project (HDF5)] " +
-        "use_deflate_compression " +
-        "export_path=["+ fused_path + "]"
+        "registration_algorithm=[Precise descriptor-based (translation invariant)] " +
+        "registration_in_between_views=[Compare all views against each other] " +
+        "interest_points=beads " +
+        "group_tiles " +
+        "group_illuminations " +
+        "group_channels " +
+        "fix_views=[Fix first view] " +
+        "map_back_views=[Do not map back (use this if views are fixed)] " +
+        "transformation=Affine " +
+        "regularize_model " +
+        "model_to_regularize_with=Rigid " +
+        "lamba=0.10 " +
+        "number_of_neighbors=3 " +
+        "redundancy=3 " +
+        "significance=2 " +
+        "allowed_error_for_ransac=5 " +
+        "ransac_iterations=Normal " +
+        "interestpoint_grouping=[Group interest points (simply combine all in one virtual view)] " +
+        "interest=5",
+        # only works on the interest points stored next to the XML
+        estimated_minutes=1
     )
 
-    shutil.rmtree(temp, ignore_errors = True) # remove temp folder
+    # select illuminations
+    if autoselect_illuminations:
+        run_stage(
+            "Select Illuminations",
+            "select=[" + project_path + "] " +
+            "selection=[Pick brightest]",
+            estimated_minutes=estimate_io_minutes(raw_size, 0, disk_throughput)
+        )
 
-# free memory in IJ
-IJ.log("collecting garbage...")
-IJ.run("Collect Garbage", "")
-time.sleep(60.0)
-IJ.run("Collect Garbage", "")
-time.sleep(60.0)
-IJ.run("Collect Garbage", "")
-time.sleep(60.0)
+    # TODO: introduce option for auto bounding box function
 
-imaris_path = locate_latest_imaris()
+    # fuse straight from the h5, the tiffs for the conversion to ims are fused slab by
+    # slab in the order its blocks are stored, otherwise a fused h5/xml is saved
+    if fuse:
+        if dry_run:
+            # the h5 doesn't exist yet, it is about the size of the raw data
+            stitched_filesize = raw_size
+        else:
+            stitched_filesize = os.path.getsize( project_path.replace(".xml",".h5") )
+        free_memory = get_free_memory()
+        print("stitched_filesize " + str(stitched_filesize))
+        print("free memory in ij " + str(free_memory))
+        fused_bytes = stitched_filesize / downsampling**3
 
-if fuse and convert_to_ims and imaris_path:
-    IJ.log("converting to Imaris5 format...")
+        if convert_to_ims:
+            if not dry_run and not os.path.exists(temp):
+                os.mkdir(temp)
+            slab_depth = hdf5_layout["chunk_sizes"][0][2]
+            fused_output = run_stage(
+                "Fuse dataset from H5 (block-cached)",
+                "select=[" + project_path + "] " +
+                "downsampling=" + str(downsampling) + " " +
+                "slab_depth=" + str(slab_depth) + " " +
+                "export_path=[" + temp + "]",
+                output_dir=temp,
+                expected_bytes=fused_bytes,
+                estimated_minutes=estimate_io_minutes(stitched_filesize, fused_bytes, disk_throughput),
+                action=lambda: fuse_from_h5(project_path, temp, downsampling, slab_depth)
+            )
+        else:
+            # TODO: include in below calculation downsampling * t_end, since only one t is fused at a time.
+            if free_memory > (1.94 * stitched_filesize / downsampling):
+                ram_handling = "[Precompute Image]"
+            else:
+                ram_handling = "Cached"
+            print("fusion mode used " + str(ram_handling))
 
-    first_fused_tif = temp + "/fused_tp_0_ch_0.tif"
-    os.chdir(locate_latest_imaris())
-    command = 'ImarisConvert.exe -i "%s" -of Imaris5 -o "%s" -fsdc _CH_ -fsdt _TP_' % (
-        first_fused_tif,
-        first_czi.replace(".czi", ".ims"),
-    )
-    # print("\n%s" % command)
-    IJ.log("Converting to Imaris5 .ims...")
-    subprocess.call(command, shell=True)
-    IJ.log("Conversion to .ims is finished")
-
-
-if not imaris_path:
-    print("Can't find Imaris path, conversion will be skipped")
-
-total_execution_time_min = round( (time.time() - execution_start_time) / 60.0 )
-
-if email_address:
-    send_mail( "imcf@unibas.ch", email_address, filename, total_execution_time_min )
-else:
-    print("Email address field is empty, no email was sent")
-
-IJ.log("\n~~~ Job summary ~~~")
-IJ.log("Filename: " + str( filename ))
-IJ.log("Automatically select best illumination side: " + str( autoselect_illuminations ))
-IJ.log("Fuse image: " + str( fuse ))
-IJ.log("Downsample fused image: " + str( downsampling ))
-IJ.log("Convert fused image to Imaris5: " + str( convert_to_ims ))
-IJ.log("Send info email to: " + str( email_address ))
-IJ.log("Total time in minutes: " + str( total_execution_time_min ))
-IJ.log("All done")
-IJ.selectWindow("Log")
-IJ.saveAs("Text", str(first_czi).replace(".czi", "") + "_MultiviewReconstruction_Log")
+            run_stage(
+                "Fuse dataset ...",
+                "select=[" + project_path + "] " +
+                "process_angle=[All angles] " +
+                "process_channel=[All channels] " +
+                "process_illumination=[All illuminations] " +
+                "process_tile=[All tiles] " +
+                "process_timepoint=[All Timepoints] " +
+                "bounding_box=[Currently Selected Views] " +
+                "downsampling=" + str(downsampling) + " " +
+                "pixel_type=[16-bit unsigned integer] " +
+                "interpolation=[Linear Interpolation] " +
+                "image=" + ram_handling + " " +
+                "interest_points_for_non_rigid=[-= Disable Non-Rigid =-] " +
+                "blend produce=[Each timepoint & channel] " +
+                "fused_image=[Save as new XML Project (HDF5)] " +
+                "use_deflate_compression " +
+                "export_path=["+ fused_path + "]",
+                output_dir=os.path.dirname(fused_path),
+                expected_bytes=fused_bytes,
+                estimated_minutes=estimate_io_minutes(stitched_filesize, fused_bytes, disk_throughput)
+            )
+
+    imaris_path = locate_latest_imaris()
+
+    if dry_run:
+        plan_summary = {
+            "Views processed": "%s series x %s channels x %s timepoints" % (
+                czi_info["nbr_series"], czi_info["nbr_chnl"], czi_info["nbr_tp"]
+            ),
+            "Raw data size": convert_bytes(raw_size),
+            "Disk throughput": convert_bytes(disk_throughput) + "/s",
+            "Free memory in IJ": convert_bytes(get_free_memory()),
+            "HDF5 layout": hdf5_layout,
+            "Convert to Imaris5": bool(fuse and convert_to_ims and imaris_path),
+        }
+        if fuse:
+            plan_summary["Fused output"] = temp if convert_to_ims else fused_path
+        print_plan(plan, plan_summary, first_czi.replace(".czi", "") + "_plan.json")
+    else:
+        # free memory in IJ
+        IJ.log("collecting garbage...")
+        IJ.run("Collect Garbage", "")
+        time.sleep(60.0)
+        IJ.run("Collect Garbage", "")
+        time.sleep(60.0)
+        IJ.run("Collect Garbage", "")
+        time.sleep(60.0)
+
+    if fuse and convert_to_ims and imaris_path and not dry_run:
+        IJ.log("converting to Imaris5 format...")
+
+        first_fused_tif = temp + "/fused_tp_0_ch_0.tif"
+        os.chdir(locate_latest_imaris())
+        command = 'ImarisConvert.exe -i "%s" -of Imaris5 -o "%s" -fsdc _CH_ -fsdt _TP_' % (
+            first_fused_tif,
+            first_czi.replace(".czi", ".ims"),
+        )
+        # print("\n%s" % command)
+        IJ.log("Converting to Imaris5 .ims...")
+        return_code = subprocess.call(command, shell=True)
+        IJ.log("Conversion to .ims is finished")
+        if return_code:
+            problems.append("ImarisConvert failed with exit code %s" % return_code)
+
+        IJ.log("Verifying .ims file...")
+        ims_path = first_czi.replace(".czi", ".ims")
+        if os.path.exists(ims_path):
+            problems += verify_hdf5_datasets(
+                ims_path,
+                [
+                    "/DataSet/ResolutionLevel 0/TimePoint %d/Channel %d/Data" % (tp, chnl)
+                    for tp in range(czi_info["nbr_tp"])
+                    for chnl in range(czi_info["nbr_chnl"])
+                ],
+                fused_output["dimensions"],
+                allow_padding=True,
+            )
+            manifest[ims_path] = {"bytes": os.path.getsize(ims_path)}
+        else:
+            problems.append(ims_path + " was not written")
+
+    if not imaris_path:
+        print("Can't find Imaris path, conversion will be skipped")
+        # the fused TIFFs in temp are the only fused output, they must not be deleted
+        if fuse and convert_to_ims and not dry_run:
+            problems.append("ImarisConvert wasn't found, the .ims was not written")
+
+    if fuse and convert_to_ims and not dry_run:
+        manifest.update(fused_output["outputs"])
+        for tiff_path in fused_output["outputs"]:
+            if not os.path.exists(tiff_path):
+                problems.append(tiff_path + " was not written")
+        if not fused_output["files"]:
+            problems.append("no fused TIFF found in " + temp)
+
+    if fuse and not convert_to_ims and not dry_run:
+        IJ.log("Verifying fused .h5 file...")
+        fused_h5 = fused_path.replace(".xml", ".h5")
+        if os.path.exists(fused_path):
+            problems += verify_hdf5_datasets(
+                fused_h5,
+                [
+                    "/t%05d/s%02d/0/cells" % (tp, setup)
+                    for tp in range(czi_info["nbr_tp"])
+                    for setup in range(czi_info["nbr_chnl"])
+                ],
+                get_fused_dimensions(fused_path),
+            )
+        else:
+            problems.append(fused_path + " was not written")
+        if os.path.exists(fused_h5):
+            manifest[fused_h5] = {"bytes": os.path.getsize(fused_h5)}
+
+    if fuse and not dry_run:
+        for problem in problems:
+            IJ.log("Verification failed: " + problem)
+        write_json(
+            first_czi.replace(".czi", "") + "_manifest.json",
+            {"outputs": manifest, "verified": not problems, "problems": problems},
+        )
+
+    # remove temp folder, but only if the outputs are complete
+    if fuse and convert_to_ims and not dry_run:
+        if problems:
+            IJ.log("Keeping intermediate files in " + temp + " as verification failed")
+        else:
+            shutil.rmtree(temp, ignore_errors=True)
+
+    total_execution_time_min = round( (time.time() - execution_start_time) / 60.0 )
+
+    if dry_run:
+        print("Dry run, no email was sent")
+    elif email_address:
+        send_mail( "imcf@unibas.ch", email_address, filename, total_execution_time_min )
+    else:
+        print("Email address field is empty, no email was sent")
+
+    IJ.log("\n~~~ Job summary ~~~")
+    IJ.log("Filename: " + str( filename ))
+    IJ.log("Automatically select best illumination side: " + str( autoselect_illuminations ))
+    IJ.log("Fuse image: " + str( fuse ))
+    IJ.log("Downsample fused image: " + str( downsampling ))
+    IJ.log("Convert fused image to Imaris5: " + str( convert_to_ims ))
+    if fuse and not dry_run:
+        IJ.log("Outputs verified: " + str(not problems))
+    IJ.log("Send info email to: " + str( email_address ))
+    IJ.log("Total time in minutes: " + str( total_execution_time_min ))
+    IJ.log("All done")
+    # a dry run only writes its plan
+    if not dry_run:
+        IJ.selectWindow("Log")
+        IJ.saveAs("Text", str(first_czi).replace(".czi", "") + "_MultiviewReconstruction_Log")
+finally:
+    if not dry_run:
+        monitor.stop()